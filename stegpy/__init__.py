@@ -1 +1,13 @@
 name = "stegpy"
+
+from .api import (
+    CapacityError,
+    DecryptionError,
+    ExtractedPayload,
+    PayloadNotFoundError,
+    StegpyError,
+    UnsupportedFormatError,
+    capacity,
+    embed,
+    extract,
+)
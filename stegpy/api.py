@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+# Module for embedding and extracting payloads in memory, without printing.
+
+import io
+import os
+import tempfile
+from dataclasses import dataclass
+from typing import Optional
+
+import jpeglib
+import numpy
+from PIL import Image
+
+try:
+    from . import crypt, lsb
+except:
+    import crypt
+    import lsb
+
+IMAGE_FORMATS = {"png": "PNG", "bmp": "BMP", "webp": "WEBP"}
+FORMATS = set(IMAGE_FORMATS) | {"gif", "wav"} | lsb.JPEG_FORMATS
+ALLOWED_BITS = {1, 2, 4}
+HEADER_BYTES = 11
+
+
+class StegpyError(Exception):
+    """Base class of the errors raised by the in-memory API."""
+
+
+class UnsupportedFormatError(StegpyError, ValueError):
+    """Raised for host formats the in-memory API cannot handle."""
+
+
+class CapacityError(StegpyError):
+    """Raised when a payload does not fit in its host."""
+
+
+class PayloadNotFoundError(StegpyError):
+    """Raised when a host holds no complete stegpy payload."""
+
+
+class DecryptionError(StegpyError):
+    """Raised when an encrypted payload cannot be decrypted with a password."""
+
+
+@dataclass(frozen=True)
+class ExtractedPayload:
+    payload: bytes
+    filename: Optional[str] = None
+
+
+def embed(
+    host,
+    fmt,
+    payload,
+    bits=2,
+    filename=None,
+    password=None,
+    profile=lsb.DEFAULT_SAVE_PROFILE,
+    cipher=crypt.DEFAULT_CIPHER,
+    kdf=crypt.DEFAULT_KDF,
+    iterations=crypt.DEFAULT_ITERATIONS,
+):
+    """Hides payload in a host given as bytes or a binary file object.
+
+    fmt is the host format, such as "png" or "wav". filename is stored with
+    the payload like the CLI does for hidden files. cipher picks the
+    encrypted envelope used with a password; extract detects it. For
+    batches sharing a password, kdf="pbkdf2-hkdf" derives the password key
+    once per process and a per-payload key with HKDF. iterations is the
+    PBKDF2 cost, stored in the payload; see crypt.calibrate_iterations.
+    Returns the new host bytes in the same format.
+    """
+    fmt = check_format(fmt)
+    check_bits(bits)
+    lsb.check_save_profile(profile)
+    crypt.check_cipher(cipher)
+    crypt.check_kdf(kdf)
+    crypt.check_iterations(iterations)
+    data = read_host(host)
+    message = format_payload(payload, filename, password, cipher, kdf, iterations)
+
+    if fmt in lsb.JPEG_FORMATS:
+        return embed_jpeg(data, message, bits)
+    if fmt == "wav":
+        return embed_wav(data, message, bits)
+    if fmt == "gif":
+        header, frames = lsb.get_gif_file(io.BytesIO(data))
+        embed_lsb(frames, message, bits)
+        output = io.BytesIO()
+        lsb.save_gif_file(output, header, frames)
+        return output.getvalue()
+
+    pixels = read_pixels(data)
+    embed_lsb(pixels, message, bits)
+    output = io.BytesIO()
+    Image.fromarray(pixels).save(
+        output,
+        format=IMAGE_FORMATS[fmt],
+        **lsb.image_save_options("host." + fmt, profile),
+    )
+    return output.getvalue()
+
+
+def extract(host, fmt, password=None, max_iterations=crypt.MAX_ITERATIONS):
+    """Returns the ExtractedPayload hidden in a host bytes or file object.
+
+    Encrypted payloads asking for more than max_iterations of PBKDF2 raise
+    DecryptionError without deriving a key.
+    """
+    fmt = check_format(fmt)
+    data = read_host(host)
+
+    if fmt in lsb.JPEG_FORMATS:
+        channels = read_jpeg_channels(data)
+        decode = lambda length: lsb.decode_jpeg_message(channels, length)
+    elif fmt == "wav":
+        sound = numpy.frombuffer(data, dtype=numpy.uint8)
+        start, stop = lsb.wav_data_range(io.BytesIO(data), len(data))
+        host_data = lsb.wav_message_data(sound, start, sound[start:stop])
+        decode = lambda length: lsb.decode_message(host_data, length)
+    elif fmt == "gif":
+        frames = lsb.get_gif_file(io.BytesIO(data))[1]
+        decode = lambda length: lsb.decode_message(frames, length)
+    else:
+        pixels = read_pixels(data)
+        decode = lambda length: lsb.decode_message(pixels, length)
+
+    raw = lsb.read_embedded_message(decode, bool(password))
+    return parse_payload(raw, password, max_iterations)
+
+
+def capacity(host, fmt, bits=2):
+    """Returns how many formatted payload bytes fit in a host."""
+    fmt = check_format(fmt)
+    check_bits(bits)
+    data = read_host(host)
+
+    if fmt in lsb.JPEG_FORMATS:
+        return lsb.jpeg_free_space(read_jpeg_channels(data), bits)
+    if fmt == "wav":
+        start, stop = lsb.wav_data_range(io.BytesIO(data), len(data))
+        carriers = stop - start
+    elif fmt == "gif":
+        carriers = lsb.get_gif_file(io.BytesIO(data))[1].size
+    else:
+        with Image.open(io.BytesIO(data)) as image:
+            carriers = image.size[0] * image.size[1] * 3
+    return lsb.carriers_free_space(carriers, fmt, bits)
+
+
+def format_payload(
+    payload,
+    filename=None,
+    password=None,
+    cipher=crypt.DEFAULT_CIPHER,
+    kdf=crypt.DEFAULT_KDF,
+    iterations=crypt.DEFAULT_ITERATIONS,
+):
+    """Adds the stegpy header, and encryption when a password is given."""
+    payload = bytes(payload)
+    embedded_name = os.path.basename(filename) if filename else None
+    payload_length = len(payload).to_bytes(4, "big")
+    message = lsb.format_message(payload, payload_length, embedded_name)
+    if password:
+        message = crypt.encrypt_info(password, message, cipher, kdf, iterations)
+    return message
+
+
+def parse_payload(raw, password=None, max_iterations=crypt.MAX_ITERATIONS):
+    """Splits decoded host bytes into an ExtractedPayload."""
+    message = bytes(raw)
+    if password:
+        try:
+            message = crypt.decrypt_embedded_info(password, message, max_iterations)
+        except Exception as exc:
+            raise DecryptionError("Wrong password.") from exc
+
+    if len(message) < HEADER_BYTES or message[:6] != lsb.MAGIC_NUMBER:
+        raise PayloadNotFoundError("No stegpy payload was found in this host file.")
+
+    payload_length = int.from_bytes(message[6:10], "big")
+    filename_length = message[10]
+    payload_start = HEADER_BYTES + filename_length
+    payload_end = payload_start + payload_length
+    if payload_end > len(message):
+        raise PayloadNotFoundError("The stegpy payload is incomplete.")
+
+    filename = None
+    if filename_length:
+        try:
+            filename = message[HEADER_BYTES:payload_start].decode("utf-8")
+        except UnicodeDecodeError as exc:
+            raise PayloadNotFoundError("The embedded filename is not UTF-8.") from exc
+    return ExtractedPayload(message[payload_start:payload_end], filename)
+
+
+def check_format(fmt):
+    fmt = str(fmt).lower().lstrip(".")
+    if fmt not in FORMATS:
+        raise UnsupportedFormatError(
+            "Unsupported host format {!r}; use one of: {}.".format(
+                fmt, ", ".join(sorted(FORMATS))
+            )
+        )
+    return fmt
+
+
+def check_bits(bits):
+    if bits not in ALLOWED_BITS:
+        raise ValueError("Bits must be one of 1, 2, or 4.")
+
+
+def read_host(host):
+    if hasattr(host, "read"):
+        return host.read()
+    return bytes(host)
+
+
+def read_pixels(data):
+    with Image.open(io.BytesIO(data)) as image:
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        return numpy.array(image)
+
+
+def embed_lsb(host_data, message, bits):
+    host_data = host_data.reshape(-1)
+    max_message_len = host_data.size // (8 // bits)
+    if max_message_len < len(message):
+        raise CapacityError(
+            "The host holds {:,} bytes but the payload needs {:,}.".format(
+                max_message_len, len(message)
+            )
+        )
+    lsb.encode_message_prefix(host_data, message, bits)
+
+
+def embed_wav(data, message, bits):
+    data = bytearray(data)
+    start, stop = lsb.wav_data_range(io.BytesIO(data), len(data))
+    embed_lsb(numpy.frombuffer(data, dtype=numpy.uint8)[start:stop], message, bits)
+    return bytes(data)
+
+
+def read_jpeg_channels(data):
+    """Loads JPEG DCT coefficients; jpeglib only reads from paths."""
+    with tempfile.TemporaryDirectory(prefix="stegpy-") as directory:
+        path = os.path.join(directory, "host.jpg")
+        with open(path, "wb") as f:
+            f.write(data)
+        return lsb.get_jpeg_channels(jpeglib.read_dct(path))
+
+
+def embed_jpeg(data, message, bits):
+    with tempfile.TemporaryDirectory(prefix="stegpy-") as directory:
+        path = os.path.join(directory, "host.jpg")
+        with open(path, "wb") as f:
+            f.write(data)
+        jpeg = jpeglib.read_dct(path)
+        channels = lsb.get_jpeg_channels(jpeg)
+        carrier_sets, total_carriers = lsb.get_jpeg_carrier_sets(channels)
+        max_message_len = max(0, (total_carriers - 1) * bits // 8)
+        if max_message_len < len(message):
+            raise CapacityError(
+                "The host holds {:,} bytes but the payload needs {:,}.".format(
+                    max_message_len, len(message)
+                )
+            )
+        lsb.encode_jpeg_carriers(channels, carrier_sets, message, bits)
+        jpeg.write_dct(path)
+        with open(path, "rb") as f:
+            return f.read()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# Module for caching host metadata keyed by file identity.
+
+import collections
+import contextlib
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+CACHE_DIR_ENV = "STEGPY_CACHE_DIR"
+DEFAULT_CACHE_SIZE = 256
+HASH_PREFIX_BYTES = 64 * 1024
+DEFAULT_KEY_CACHE_SIZE = 16
+DEFAULT_KEY_TTL = 300.0
+
+
+def file_key(filename):
+    """Identify a file by content: extension, size and a hash of both ends.
+
+    The path and mtime are left out, so copies of a host, such as each
+    request's upload in the web demo, share cache entries. Hashing the last
+    bytes too covers containers that keep their index at the end. Returns
+    None when the file cannot be read, so callers skip the cache.
+    """
+    extension = os.path.splitext(os.fspath(filename))[1].lower()
+    try:
+        with open(filename, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            digest = hashlib.sha256(f.read(HASH_PREFIX_BYTES))
+            if size > HASH_PREFIX_BYTES:
+                f.seek(max(HASH_PREFIX_BYTES, size - HASH_PREFIX_BYTES))
+                digest.update(f.read())
+    except OSError:
+        return None
+    return "{}\0{}\0{}".format(extension, size, digest.hexdigest())
+
+
+class MetadataCache:
+    """In-memory LRU of JSON-serializable metadata with an optional disk store."""
+
+    def __init__(self, maxsize=DEFAULT_CACHE_SIZE, directory=None):
+        self.maxsize = maxsize
+        self.directory = directory
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, namespace, filename):
+        key = file_key(filename)
+        if key is None:
+            return None
+        key = namespace + "\0" + key
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+
+        value = self._load(key)
+        if value is not None:
+            self._remember(key, value)
+        return value
+
+    def put(self, namespace, filename, value):
+        key = file_key(filename)
+        if key is None:
+            return
+        key = namespace + "\0" + key
+        self._remember(key, value)
+        self._store(key, value)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def _remember(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def _path(self, key):
+        name = hashlib.sha256(key.encode("utf-8")).hexdigest() + ".json"
+        return os.path.join(self.directory, name)
+
+    def _load(self, key):
+        if not self.directory:
+            return None
+        try:
+            with open(self._path(key), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _store(self, key, value):
+        if not self.directory:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            handle, temporary = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        except OSError:
+            return
+        try:
+            with os.fdopen(handle, "w", encoding="utf-8") as f:
+                json.dump(value, f)
+            os.replace(temporary, self._path(key))
+        except OSError:
+            with contextlib.suppress(OSError):
+                os.remove(temporary)
+
+
+class KeyCache:
+    """In-memory LRU of secret keys that expire ttl seconds after being stored.
+
+    Keys are kept in bytearrays that are overwritten with zeros when they are
+    evicted, expire or the cache is cleared. Callers get copies, which Python
+    cannot zero, so the cache only bounds how long keys stay reachable.
+    """
+
+    def __init__(self, maxsize=DEFAULT_KEY_CACHE_SIZE, ttl=DEFAULT_KEY_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires <= time.monotonic():
+                self._discard(key)
+                return None
+            self.entries.move_to_end(key)
+            return bytes(value)
+
+    def put(self, key, value):
+        with self.lock:
+            if key in self.entries:
+                self._discard(key)
+            self.entries[key] = (time.monotonic() + self.ttl, bytearray(value))
+            while len(self.entries) > self.maxsize:
+                self._discard(next(iter(self.entries)))
+
+    def clear(self):
+        with self.lock:
+            for key in list(self.entries):
+                self._discard(key)
+
+    def _discard(self, key):
+        value = self.entries.pop(key)[1]
+        value[:] = bytes(len(value))
+
+
+probe_cache = MetadataCache(directory=os.environ.get(CACHE_DIR_ENV) or None)
+key_cache = KeyCache()
+
+
+def set_cache_directory(directory):
+    """Enable (or, with None, disable) the on-disk store of the probe cache."""
+    probe_cache.directory = os.fspath(directory) if directory else None
@@ -2,44 +2,423 @@
 # Module for encrypting byte arrays.
 
 import base64
+import hashlib
+import io
 import os
+import re
 import string
+import struct
+import time
 
 from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 
+try:
+    from . import cache
+except:
+    import cache
+
+FERNET_TOKEN_PATTERN = re.compile(rb"[A-Za-z0-9_-]*=*")
+FERNET_TOKEN_PREFIX = b"gAAAAA"  # version byte and high timestamp bytes
+SALT_SIZE = 16
+ENVELOPE_MAGIC = b"stegc"
+ENVELOPE_HEADER = struct.Struct(">5sBI")  # magic, version, ciphertext length
+FERNET = "fernet"
+AES_GCM = "aes-gcm"
+AES_GCM_STREAM = "aes-gcm-stream"
+CIPHERS = {FERNET: 1, AES_GCM: 2, AES_GCM_STREAM: 3}  # name: envelope version
+DEFAULT_CIPHER = AES_GCM
+AES_GCM_NONCE_SIZE = 12
+AES_GCM_TAG_SIZE = 16
+STREAM_CHUNK_SIZE = 1 << 16
+STREAM_HEADER = struct.Struct(">8sI")  # nonce prefix, plaintext chunk size
+PBKDF2 = "pbkdf2"
+BATCH_KDF = "pbkdf2-hkdf"
+KDFS = {PBKDF2: 1, BATCH_KDF: 2}  # name: key block id
+DEFAULT_KDF = PBKDF2
+KDF_FLAG = 0x80  # set in every envelope version: a key block follows the header
+KDF_HEADER = struct.Struct(">BI")  # KDF id, PBKDF2 iterations; salts follow
+LEGACY_ITERATIONS = 100000  # iterations of salt-prefixed Fernet payloads
+DEFAULT_ITERATIONS = LEGACY_ITERATIONS
+MIN_ITERATIONS = 10000
+MAX_ITERATIONS = 20000000  # bounds the work a crafted header can cause
+CALIBRATION_ITERATIONS = 20000
+
 
 def derive_key(password, salt=None):
+    """Returns a base64 Fernet key for envelopes without a key block."""
+    key, salt = derive_raw_key(password, salt, LEGACY_ITERATIONS)
+    return [base64.urlsafe_b64encode(key), salt]
+
+
+def derive_raw_key(password, salt=None, iterations=DEFAULT_ITERATIONS):
+    """Returns a 32-byte PBKDF2 key and its salt."""
     if not salt:
-        salt = os.urandom(16)
+        salt = os.urandom(SALT_SIZE)
     kdf = PBKDF2HMAC(
         algorithm=hashes.SHA256(),
         length=32,
         salt=salt,
-        iterations=100000,
+        iterations=iterations,
         backend=default_backend(),
     )
 
-    return [base64.urlsafe_b64encode(kdf.derive(password)), salt]
+    return [kdf.derive(password), salt]
+
+
+def check_iterations(iterations, max_iterations=MAX_ITERATIONS):
+    if not MIN_ITERATIONS <= iterations <= max_iterations:
+        raise ValueError(
+            "PBKDF2 iterations must be between {:,} and {:,}.".format(
+                MIN_ITERATIONS, max_iterations
+            )
+        )
+
+
+def calibrate_iterations(target_seconds, samples=3):
+    """Returns the PBKDF2 iteration count that takes about target_seconds here.
+
+    The fastest of a few short derivations is scaled up, rounded to a
+    thousand and kept within MIN_ITERATIONS and MAX_ITERATIONS. Decoding
+    payloads written with the result costs about as long on similar machines.
+    """
+    elapsed = None
+    for _ in range(samples):
+        start = time.perf_counter()
+        derive_raw_key(b"calibration", bytes(SALT_SIZE), CALIBRATION_ITERATIONS)
+        sample = time.perf_counter() - start
+        elapsed = sample if elapsed is None else min(elapsed, sample)
+    iterations = CALIBRATION_ITERATIONS * target_seconds / max(elapsed, 1e-9)
+    iterations = int(round(iterations, -3))
+    return min(MAX_ITERATIONS, max(MIN_ITERATIONS, iterations))
+
+
+def password_digest(password):
+    """Names a password in the key cache without keeping the password."""
+    return hashlib.sha256(b"stegpy key cache\0" + password).digest()
+
+
+def master_cache_key(password, iterations):
+    return password_digest(password) + iterations.to_bytes(4, "big")
+
+
+def derive_master_key(password, salt, iterations):
+    """Returns the PBKDF2 key of a batch master salt, cached per process."""
+    cache_key = master_cache_key(password, iterations) + salt
+    key = cache.key_cache.get(cache_key)
+    if key is None:
+        key = derive_raw_key(password, salt, iterations)[0]
+        cache.key_cache.put(cache_key, key)
+    return key
+
+
+def batch_master_key(password, iterations):
+    """Returns the (salt, key) master pair shared by a batch of payloads.
+
+    The pair is derived once and reused until it leaves the key cache.
+    """
+    cache_key = master_cache_key(password, iterations)
+    entry = cache.key_cache.get(cache_key)
+    if entry is not None:
+        return entry[:SALT_SIZE], entry[SALT_SIZE:]
+    key, salt = derive_raw_key(password, iterations=iterations)
+    cache.key_cache.put(cache_key, salt + key)
+    cache.key_cache.put(cache_key + salt, key)
+    return salt, key
+
+
+def derive_file_key(master_key, file_salt):
+    """Expands a batch master key into the key of one payload with HKDF."""
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=file_salt,
+        info=b"stegpy payload key",
+        backend=default_backend(),
+    ).derive(master_key)
+
+
+def key_block_size(kdf=DEFAULT_KDF):
+    check_kdf(kdf)
+    salt_count = 2 if kdf == BATCH_KDF else 1
+    return KDF_HEADER.size + salt_count * SALT_SIZE
+
+
+def new_key_block(password, kdf=DEFAULT_KDF, iterations=DEFAULT_ITERATIONS):
+    """Returns a fresh key and the key block that lets readers derive it.
+
+    The block starts with the KDF id and PBKDF2 iteration count. With PBKDF2
+    the salt follows. With the batch KDF the master salt and a random
+    per-payload salt fed to HKDF follow, so only the first payload of a
+    batch pays for PBKDF2.
+    """
+    check_iterations(iterations)
+    header = KDF_HEADER.pack(KDFS[kdf], iterations)
+    if kdf == BATCH_KDF:
+        master_salt, master_key = batch_master_key(password, iterations)
+        file_salt = os.urandom(SALT_SIZE)
+        block = header + master_salt + file_salt
+        return derive_file_key(master_key, file_salt), block
+    key, salt = derive_raw_key(password, iterations=iterations)
+    return key, header + bytes(salt)
+
+
+def read_key_block(password, read, max_iterations=MAX_ITERATIONS):
+    """Derives the key of an envelope from the key block read(size) returns.
 
+    Returns the key and the block size. Stored iteration counts above
+    max_iterations are rejected before any key derivation.
+    """
+    header = bytes(read(KDF_HEADER.size))
+    if len(header) != KDF_HEADER.size:
+        raise ValueError("The encrypted payload is incomplete.")
+    kdf_id, iterations = KDF_HEADER.unpack(header)
+    kdf = next((name for name, value in KDFS.items() if value == kdf_id), None)
+    if kdf is None:
+        raise ValueError("Unsupported key derivation in encrypted payload.")
+    check_iterations(iterations, max_iterations)
+    salts = bytes(read(key_block_size(kdf) - KDF_HEADER.size))
+    if len(salts) != key_block_size(kdf) - KDF_HEADER.size:
+        raise ValueError("The encrypted payload is incomplete.")
+    if kdf == BATCH_KDF:
+        master_salt, file_salt = salts[:SALT_SIZE], salts[SALT_SIZE:]
+        master_key = derive_master_key(password, master_salt, iterations)
+        key = derive_file_key(master_key, file_salt)
+    else:
+        key = derive_raw_key(password, salts, iterations)[0]
+    return key, key_block_size(kdf)
 
-def encrypt_info(password, info):
-    """Receives a password and a byte array. Returns a Fernet token."""
+
+def envelope_version(cipher):
+    return CIPHERS[cipher] | KDF_FLAG
+
+
+def check_kdf(kdf):
+    if kdf not in KDFS:
+        raise ValueError("KDF must be one of: {}.".format(", ".join(sorted(KDFS))))
+
+
+def check_cipher(cipher):
+    if cipher not in CIPHERS:
+        raise ValueError(
+            "Cipher must be one of: {}.".format(", ".join(sorted(CIPHERS)))
+        )
+
+
+def encrypt_info(
+    password,
+    info,
+    cipher=DEFAULT_CIPHER,
+    kdf=DEFAULT_KDF,
+    iterations=DEFAULT_ITERATIONS,
+):
+    """Receives a password and a byte array. Returns an encrypted envelope.
+
+    The envelope is a header holding the cipher and ciphertext length,
+    followed by the key block (the KDF, its iteration count and salts) and
+    either a Fernet token or, for AES-GCM, a nonce and the binary ciphertext
+    and tag. AES-GCM skips Fernet's base64 and padding, and authenticates
+    the header as associated data.
+    """
+    check_cipher(cipher)
+    check_kdf(kdf)
+    if cipher == AES_GCM_STREAM:
+        pieces = encrypt_stream(
+            password, [info], len(info), kdf=kdf, iterations=iterations
+        )
+        return b"".join(pieces)
     password = bytes((password).encode("utf-8"))
-    key, salt = derive_key(password)
-    f = Fernet(key)
-    token = f.encrypt(info)
-    return bytes(salt) + bytes(token)
+    key, block = new_key_block(password, kdf, iterations)
+    size = encrypted_info_size(len(info), cipher, kdf) - ENVELOPE_HEADER.size
+    header = ENVELOPE_HEADER.pack(ENVELOPE_MAGIC, envelope_version(cipher), size)
+    if cipher == AES_GCM:
+        nonce = os.urandom(AES_GCM_NONCE_SIZE)
+        ciphertext = AESGCM(key).encrypt(nonce, bytes(info), header)
+        return header + block + nonce + ciphertext
+
+    f = Fernet(base64.urlsafe_b64encode(key))
+    return header + block + bytes(f.encrypt(info))
 
 
-def encrypted_info_size(info_length):
-    """Return the salt-prefixed Fernet size for a plaintext byte length."""
+def fernet_token_size(info_length):
+    """Return the Fernet token size for a plaintext byte length."""
     padded_length = (info_length // 16 + 1) * 16
     raw_token_length = 57 + padded_length
-    encoded_token_length = 4 * ((raw_token_length + 2) // 3)
-    return 16 + encoded_token_length
+    return 4 * ((raw_token_length + 2) // 3)
+
+
+def encrypted_info_size(info_length, cipher=DEFAULT_CIPHER, kdf=DEFAULT_KDF):
+    """Return the encrypted envelope size for a plaintext byte length."""
+    check_cipher(cipher)
+    if cipher == AES_GCM:
+        ciphertext_size = AES_GCM_NONCE_SIZE + info_length + AES_GCM_TAG_SIZE
+    elif cipher == AES_GCM_STREAM:
+        ciphertext_size = stream_ciphertext_size(info_length)
+    else:
+        ciphertext_size = fernet_token_size(info_length)
+    return ENVELOPE_HEADER.size + key_block_size(kdf) + ciphertext_size
+
+
+def stream_ciphertext_size(info_length, chunk_size=STREAM_CHUNK_SIZE):
+    """Return the size of a chunked AES-GCM stream after its key block."""
+    chunk_count = max(1, -(-info_length // chunk_size))
+    return STREAM_HEADER.size + info_length + chunk_count * AES_GCM_TAG_SIZE
+
+
+def iter_fixed_chunks(pieces, chunk_size):
+    """Regroups byte pieces into chunk_size chunks, the last one may be shorter."""
+    buffer = bytearray()
+    for piece in pieces:
+        piece = memoryview(piece).cast("B")
+        while piece:
+            taken = chunk_size - len(buffer)
+            buffer += piece[:taken]
+            piece = piece[taken:]
+            if len(buffer) == chunk_size:
+                yield bytes(buffer)
+                buffer.clear()
+    if buffer:
+        yield bytes(buffer)
+
+
+def stream_chunk_nonce(prefix, index):
+    return prefix + index.to_bytes(4, "big")
+
+
+def stream_chunk_data(header, last):
+    """Associated data of a chunk; the flag stops truncation at a chunk edge."""
+    return header + (b"\x01" if last else b"\x00")
+
+
+def encrypt_stream(
+    password,
+    pieces,
+    info_length,
+    chunk_size=STREAM_CHUNK_SIZE,
+    kdf=DEFAULT_KDF,
+    iterations=DEFAULT_ITERATIONS,
+):
+    """Yields a chunked AES-GCM envelope for plaintext given as byte pieces.
+
+    info_length is the total size of the pieces, which goes in the header.
+    Only one chunk of plaintext and ciphertext is held at a time, so the
+    output can be fed to an embedder without joining it.
+    """
+    check_kdf(kdf)
+    password = bytes((password).encode("utf-8"))
+    key, block = new_key_block(password, kdf, iterations)
+    aesgcm = AESGCM(key)
+    prefix = os.urandom(STREAM_HEADER.size - 4)
+    ciphertext_size = len(block) + stream_ciphertext_size(info_length, chunk_size)
+    envelope_header = ENVELOPE_HEADER.pack(
+        ENVELOPE_MAGIC, envelope_version(AES_GCM_STREAM), ciphertext_size
+    )
+    stream_header = STREAM_HEADER.pack(prefix, chunk_size)
+    header = envelope_header + stream_header
+    yield envelope_header + block + stream_header
+
+    def seal(chunk, index, last):
+        nonce = stream_chunk_nonce(prefix, index)
+        return aesgcm.encrypt(nonce, chunk, stream_chunk_data(header, last))
+
+    index = total = 0
+    previous = None
+    for chunk in iter_fixed_chunks(pieces, chunk_size):
+        if previous is not None:
+            yield seal(previous, index, False)
+            index += 1
+        previous = chunk
+        total += len(chunk)
+    if total != info_length:
+        raise ValueError(
+            "Stream plaintext is {} bytes, expected {}.".format(total, info_length)
+        )
+    yield seal(previous if previous is not None else b"", index, True)
+
+
+def decrypt_stream(password, read, max_iterations=MAX_ITERATIONS):
+    """Yields the plaintext chunks of a chunked AES-GCM envelope.
+
+    read(size) returns the next size envelope bytes, from a file or a host.
+    Every chunk is authenticated before it is yielded, so a wrong password
+    fails on the first one after a single key derivation.
+    """
+    envelope_header = bytes(read(ENVELOPE_HEADER.size))
+    envelope = read_envelope_header(envelope_header)
+    if envelope is None or envelope_cipher(envelope[0]) != AES_GCM_STREAM:
+        raise ValueError("Not a chunked AES-GCM payload.")
+    ciphertext_length = envelope[1]
+    password = bytes((password).encode("utf-8"))
+    key, block_size = read_key_block(password, read, max_iterations)
+    aesgcm = AESGCM(key)
+    stream_header = bytes(read(STREAM_HEADER.size))
+    if len(stream_header) != STREAM_HEADER.size:
+        raise ValueError("The encrypted payload is incomplete.")
+    prefix, chunk_size = STREAM_HEADER.unpack(stream_header)
+    remaining = ciphertext_length - block_size - STREAM_HEADER.size
+    if remaining < AES_GCM_TAG_SIZE or not chunk_size:
+        raise ValueError("The encrypted payload is incomplete.")
+
+    header = envelope_header + stream_header
+    index = 0
+    while remaining:
+        size = min(remaining, chunk_size + AES_GCM_TAG_SIZE)
+        sealed = bytes(read(size))
+        if len(sealed) != size:
+            raise ValueError("The encrypted payload is incomplete.")
+        remaining -= size
+        nonce = stream_chunk_nonce(prefix, index)
+        data = stream_chunk_data(header, not remaining)
+        yield aesgcm.decrypt(nonce, sealed, data)
+        index += 1
+
+
+def envelope_cipher(version):
+    """Returns the cipher name of an envelope version, or None if unknown."""
+    if not version & KDF_FLAG:
+        return None
+    for cipher, cipher_version in CIPHERS.items():
+        if cipher_version == version & ~KDF_FLAG:
+            return cipher
+    return None
+
+
+def read_envelope_header(encrypted_info):
+    """Return (version, ciphertext length) of an envelope, or None if legacy.
+
+    Legacy payloads are a bare salt followed by a Fernet token.
+    """
+    header = bytes(encrypted_info[: ENVELOPE_HEADER.size])
+    if len(header) < ENVELOPE_HEADER.size or not header.startswith(ENVELOPE_MAGIC):
+        return None
+    return ENVELOPE_HEADER.unpack(header)[1:]
+
+
+def encrypted_info_length(encrypted_info):
+    """Return the encrypted payload length at the start of decoded host bytes.
+
+    Returns None while the header, or the token of a legacy payload, could
+    still continue past the available bytes.
+    """
+    if len(encrypted_info) < ENVELOPE_HEADER.size:
+        return None
+    envelope = read_envelope_header(encrypted_info)
+    if envelope:
+        return ENVELOPE_HEADER.size + envelope[1]
+    return legacy_info_length(encrypted_info)
+
+
+def legacy_info_length(encrypted_info):
+    """Return the salt-prefixed Fernet length of a legacy payload."""
+    token = bytes(encrypted_info[SALT_SIZE:])
+    match = FERNET_TOKEN_PATTERN.match(token)
+    if match.end() == len(token):
+        return None
+    return SALT_SIZE + match.end()
 
 
 def decrypt_info(password, token, salt):
@@ -52,7 +431,11 @@ def decrypt_info(password, token, salt):
 
 
 def fernet_token_lengths(token):
-    """Yield plausible Fernet token boundaries inside decoded host bytes."""
+    """Yield plausible Fernet token boundaries inside decoded host bytes.
+
+    Only the encoded sizes Fernet can produce are tried, one per 16-byte
+    block of plaintext.
+    """
     valid_token_bytes = set(
         (string.ascii_letters + string.digits + "-_=").encode("ascii")
     )
@@ -70,16 +453,51 @@ def fernet_token_lengths(token):
         if padding_end <= max_end:
             yield padding_end
 
-    start = 4
-    for end in range(start, max_end + 1):
-        if end % 4 == 0:
-            yield end
+    info_length = 0
+    while fernet_token_size(info_length) <= max_end:
+        yield fernet_token_size(info_length)
+        info_length += 16
+
+
+def decrypt_embedded_info(password, encrypted_info, max_iterations=MAX_ITERATIONS):
+    """Decrypt an encrypted envelope, or legacy salt and token, from a host.
+
+    Envelopes record the cipher and ciphertext length, so a wrong password
+    costs one key derivation and one tag check. Legacy payloads fall back to
+    trying each plausible token boundary. Servers decrypting untrusted hosts
+    can lower max_iterations to cap the PBKDF2 work a payload may request.
+    """
+    envelope = read_envelope_header(encrypted_info)
+    if envelope is None:
+        return decrypt_legacy_info(password, encrypted_info)
+
+    version, ciphertext_length = envelope
+    cipher = envelope_cipher(version)
+    if cipher is None:
+        raise ValueError("Unsupported encrypted payload version {}.".format(version))
+    header = bytes(encrypted_info[: ENVELOPE_HEADER.size])
+    ciphertext = bytes(
+        encrypted_info[ENVELOPE_HEADER.size : ENVELOPE_HEADER.size + ciphertext_length]
+    )
+    if len(ciphertext) != ciphertext_length:
+        raise ValueError("The encrypted payload is incomplete.")
+    if cipher == AES_GCM_STREAM:
+        reader = io.BytesIO(header + ciphertext)
+        return b"".join(decrypt_stream(password, reader.read, max_iterations))
+
+    reader = io.BytesIO(ciphertext)
+    password = bytes(password.encode("utf-8"))
+    key = read_key_block(password, reader.read, max_iterations)[0]
+    if cipher == AES_GCM:
+        nonce = reader.read(AES_GCM_NONCE_SIZE)
+        return AESGCM(key).decrypt(nonce, reader.read(), header)
+    return Fernet(base64.urlsafe_b64encode(key)).decrypt(reader.read())
 
 
-def decrypt_embedded_info(password, encrypted_info):
-    """Decrypt a salt-prefixed Fernet token decoded from a host file."""
-    salt = bytes(encrypted_info[:16])
-    token = bytes(encrypted_info[16:])
+def decrypt_legacy_info(password, encrypted_info):
+    """Decrypt a salt-prefixed Fernet token written before envelopes."""
+    salt = bytes(encrypted_info[:SALT_SIZE])
+    token = bytes(encrypted_info[SALT_SIZE:])
     password = bytes((password).encode("utf-8"))
     key = derive_key(password, salt)[0]
     f = Fernet(key)
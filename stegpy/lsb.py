@@ -1,21 +1,47 @@
 #!/usr/bin/env python3
 # Module for processing images, audios and the least significant bits.
 
-import contextlib
 import os.path
-import threading
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 
 import jpeglib
 import numpy
-from PIL import GifImagePlugin, Image
+from PIL import Image
 
 try:
-    from . import crypt
+    from . import cache, crypt, pngstream
 except:
+    import cache
     import crypt
+    import pngstream
 
 MAGIC_NUMBER = b"stegv3"
 JPEG_FORMATS = {"jpg", "jpeg"}
+HEADER_PROBE_BYTES = 64
+WAV_LEGACY_HEADER_SIZE = 10000
+GIF_SPILL_BYTES = 256 * 1024 * 1024
+SAVE_PROFILES = {
+    "fast": {
+        "png": {"compress_level": 1},
+        "png_stream": {"compress_levels": (1,)},
+        "webp": {"method": 0, "quality": 0},
+    },
+    "balanced": {
+        "png": {"compress_level": 6},
+        "png_stream": {"compress_levels": (6,)},
+        "webp": {"method": 4, "quality": 80},
+    },
+    # Noisy photos often deflate best at level 1, so streamed PNGs try both
+    # ends with and without adaptive row filters. Lossless WebP has only two
+    # tiers: method 6 costs ~30x balanced for well under 1% of size.
+    "small": {
+        "png": {"compress_level": 9, "optimize": True},
+        "png_stream": {"compress_levels": (1, 9), "adaptive": True},
+    },
+}
+DEFAULT_SAVE_PROFILE = "small"
 JPEG_BITS_TO_CODE = {1: 0, 2: 1, 4: 2}
 JPEG_CODE_TO_BITS = {code: bits for bits, code in JPEG_BITS_TO_CODE.items()}
 JPEG_ZIGZAG_ORDER = [
@@ -87,20 +113,6 @@ JPEG_ZIGZAG_ORDER = [
 JPEG_ZIGZAG_OFFSETS = numpy.asarray(
     [row * 8 + col for row, col in JPEG_ZIGZAG_ORDER[1:]], dtype=numpy.int64
 )
-GIF_LOADING_LOCK = threading.Lock()
-
-
-@contextlib.contextmanager
-def preserve_gif_palette_indices():
-    with GIF_LOADING_LOCK:
-        previous = GifImagePlugin.LOADING_STRATEGY
-        GifImagePlugin.LOADING_STRATEGY = (
-            GifImagePlugin.LoadingStrategy.RGB_AFTER_DIFFERENT_PALETTE_ONLY
-        )
-        try:
-            yield
-        finally:
-            GifImagePlugin.LOADING_STRATEGY = previous
 
 
 def get_format(filename):
@@ -114,57 +126,152 @@ def is_jpeg_format(file_format):
 class HostElement:
     """This class holds information about a host element."""
 
-    def __init__(self, filename):
+    def __init__(self, filename, workers=1):
         self.filename = filename
+        self.source = filename
         self.format = get_format(filename)
-        self.header, self.data = get_file(filename)
-
-    def save(self, filename=None):
+        self.stream = pngstream.read_info(filename) if self.format == "png" else None
+        if self.stream:
+            self.header, self._data = None, None
+        else:
+            self.header, self._data = get_file(filename, workers)
+        self.rows = None
+        self.modified_bytes = 0
+
+    @property
+    def data(self):
+        """The host array. Streamable PNGs are only decoded in full on access."""
+        if self._data is None and self.stream:
+            self._data = pngstream.read_image(self.source)
+            if self.rows is not None:
+                self._data[: len(self.rows)] = self.rows
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+
+    def is_streamed(self):
+        return self._data is None and self.stream is not None
+
+    def save(self, filename=None, profile=DEFAULT_SAVE_PROFILE):
+        """Writes the host to filename, trading speed for size per profile.
+
+        Profiles only affect lossless PNG and WebP output.
+        """
+        check_save_profile(profile)
         self.filename = os.fspath(filename) if filename else "_" + self.filename
         if self.format.lower() == "wav":
-            sound = numpy.concatenate((self.header, self.data))
-            sound.tofile(self.filename)
-        elif self.format.lower() == "gif":
-            gif = []
-            palette = self.header[0]
-            for frame in self.data:
-                image = Image.fromarray(frame, mode="P")
-                image.putpalette(palette)
-                gif.append(image)
-            gif[0].save(
-                self.filename,
-                save_all=len(gif) > 1,
-                append_images=gif[1:],
-                loop=self.header[2],
-                duration=self.header[1],
-                optimize=False,
-                palette=palette,
+            save_wav_file(
+                self.source, self.filename, self.header[1], self.data, self.modified_bytes
             )
+        elif self.format.lower() == "gif":
+            save_gif_file(self.filename, self.header, self.data)
         elif is_jpeg_format(self.format):
             self.header.write_dct(self.filename)
         else:
             if not self.filename.lower().endswith(("png", "bmp", "webp")):
                 print("Host has a lossy format and will be converted to PNG.")
                 self.filename = os.path.splitext(self.filename)[0] + ".png"
-            image = Image.fromarray(self.data)
-            image.save(self.filename, lossless=True, minimize_size=True, optimize=True)
+            if (
+                self.is_streamed()
+                and self.filename.lower().endswith("png")
+                and os.path.abspath(self.filename) != os.path.abspath(self.source)
+            ):
+                rows = self.rows if self.rows is not None else self.data[:0]
+                pngstream.write_png(
+                    self.source,
+                    self.filename,
+                    rows,
+                    **SAVE_PROFILES[profile]["png_stream"],
+                )
+            else:
+                image = Image.fromarray(self.data)
+                image.save(self.filename, **image_save_options(self.filename, profile))
         print("Information encoded in {}.".format(self.filename))
 
-    def insert_message(self, message, bits=2, parasite_filename=None, password=None):
+    def insert_message(
+        self,
+        message,
+        bits=2,
+        parasite_filename=None,
+        password=None,
+        cipher=crypt.DEFAULT_CIPHER,
+        kdf=crypt.DEFAULT_KDF,
+        iterations=crypt.DEFAULT_ITERATIONS,
+    ):
         raw_message_len = len(message).to_bytes(4, "big")
+        if password and cipher == crypt.AES_GCM_STREAM and self.holds_array():
+            header = message_header(raw_message_len, parasite_filename)
+            self.insert_stream_message(
+                header, message, bits, password, kdf, iterations
+            )
+            return
         formatted_message = format_message(message, raw_message_len, parasite_filename)
         if password:
-            formatted_message = crypt.encrypt_info(password, formatted_message)
+            formatted_message = crypt.encrypt_info(
+                password, formatted_message, cipher, kdf, iterations
+            )
         if is_jpeg_format(self.format):
             self.data = encode_jpeg_message(self.data, formatted_message, bits)
+        elif self.is_streamed():
+            self.rows = encode_png_message(
+                self.source, self.stream, formatted_message, bits
+            )
         else:
             self.data = encode_message(self.data, formatted_message, bits)
+            self.modified_bytes = len(formatted_message) * (8 // bits)
+
+    def holds_array(self):
+        """Tells whether the message goes in an in-memory LSB host array."""
+        return not is_jpeg_format(self.format) and not self.is_streamed()
+
+    def insert_stream_message(
+        self, header, message, bits, password, kdf, iterations
+    ):
+        """Encrypts header and message in chunks straight into the host array.
+
+        Neither the formatted message nor the envelope is ever joined.
+        """
+        info_length = len(header) + len(message)
+        size = crypt.encrypted_info_size(info_length, crypt.AES_GCM_STREAM, kdf)
+        host_data = self.data.reshape(-1)
+        print_message_space(host_data.size, size, bits)
+        pieces = crypt.encrypt_stream(
+            password, [header, message], info_length, kdf=kdf, iterations=iterations
+        )
+        encode_message_pieces(host_data, pieces, bits)
+        self.modified_bytes = size * (8 // bits)
 
-    def read_message(self, password=None):
+    def decode(self, length=None, start=0):
+        """Decodes length hidden bytes from start, or all of them if None."""
         if is_jpeg_format(self.format):
-            msg = decode_jpeg_message(self.data)
-        else:
-            msg = decode_message(self.data)
+            return decode_jpeg_message(self.data, length, start)
+        if self.is_streamed() and self.rows is None:
+            return decode_png_message(self.source, self.stream, length, start)
+        return decode_message(self.message_data(), length, start)
+
+    def sequential_decode(self):
+        """Returns a decode function for reading hidden bytes front to back.
+
+        Streamable PNGs are then decoded row batch by row batch instead of
+        from the first row on every call.
+        """
+        if self.is_streamed() and self.rows is None:
+            return PNGMessageDecoder(self.source, self.stream).decode
+        return self.decode
+
+    def message_data(self):
+        """Returns the host bytes an existing message is read from."""
+        if self.format.lower() != "wav":
+            return self.data
+        return wav_message_data(self.header[0], self.header[1], self.data)
+
+    def read_message(self, password=None):
+        if password and self.holds_stream_envelope():
+            self.read_stream_message(password)
+            return
+        msg = read_embedded_message(self.decode, bool(password))
 
         if password:
             try:
@@ -184,25 +291,56 @@ class HostElement:
             filename = "_" + bytes(msg[11:end_filename]).decode("utf-8")
 
         else:
-            payload = bytes(msg[start:end])
+            print_text_message(bytes(msg[start:end]))
+            return
+
+        with open(filename, "wb") as f:
+            f.write(bytes(msg[start:end]))
+
+        print("File {} succesfully extracted from {}".format(filename, self.filename))
+
+    def holds_stream_envelope(self):
+        header = bytes(self.decode(crypt.ENVELOPE_HEADER.size))
+        envelope = crypt.read_envelope_header(header)
+        return bool(envelope) and (
+            crypt.envelope_cipher(envelope[0]) == crypt.AES_GCM_STREAM
+        )
+
+    def read_stream_message(self, password):
+        """Decrypts a chunked envelope while its carriers are read.
+
+        Hidden files are written one decrypted chunk at a time.
+        """
+        reader = MessageReader(self.sequential_decode())
+        chunks = crypt.decrypt_stream(password, reader.read)
+        try:
+            msg_len, filename, chunks = read_message_header(chunks)
+        except Exception:
+            print("Wrong password.")
+            return
+
+        if not filename:
             try:
-                text = payload.decode("utf-8")
-            except UnicodeDecodeError:
-                filename = "_message.bin"
-                with open(filename, "wb") as f:
-                    f.write(payload)
-                print(
-                    "Decoded payload is not valid UTF-8; wrote raw bytes to {}".format(
-                        filename
-                    )
-                )
+                message = b"".join(limit_chunks(chunks, msg_len))
+            except Exception:
+                print("The encrypted payload is corrupted.")
                 return
-
-            print(text)
+            print_text_message(message)
             return
 
+        filename = "_" + filename
         with open(filename, "wb") as f:
-            f.write(bytes(msg[start:end]))
+            try:
+                for chunk in limit_chunks(chunks, msg_len):
+                    f.write(chunk)
+            except Exception:
+                corrupted = True
+            else:
+                corrupted = False
+        if corrupted:
+            os.remove(filename)
+            print("The encrypted payload is corrupted.")
+            return
 
         print("File {} succesfully extracted from {}".format(filename, self.filename))
 
@@ -210,6 +348,9 @@ class HostElement:
         if is_jpeg_format(self.format):
             self.free = jpeg_free_space(self.data, bits)
             return self.free
+        if self.is_streamed():
+            self.free = png_carrier_count(self.stream) * bits // 8
+            return self.free
 
         shape = self.data.shape
         self.data.shape = -1
@@ -227,13 +368,151 @@ class HostElement:
         )
 
 
-def get_file(filename):
-    """Returns data from file in a list with the header and raw data."""
+def check_save_profile(profile):
+    if profile not in SAVE_PROFILES:
+        raise ValueError(
+            "Unknown save profile {!r}; use one of: {}.".format(
+                profile, ", ".join(SAVE_PROFILES)
+            )
+        )
+
+
+def image_save_options(filename, profile=DEFAULT_SAVE_PROFILE):
+    """Returns the Pillow save options of a lossless image host for a profile."""
+    file_format = get_format(filename)
+    if file_format == "webp":
+        webp = SAVE_PROFILES[profile].get("webp", SAVE_PROFILES["balanced"]["webp"])
+        return {"lossless": True, **webp}
+    if file_format == "png":
+        return dict(SAVE_PROFILES[profile]["png"])
+    return {}
+
+
+def host_carriers(filename):
+    """Returns the carrier count of a host file, using the probe cache.
+
+    Carriers are host bytes for LSB hosts and AC coefficients for JPEG hosts.
+    """
+    carriers = cache.probe_cache.get("host", filename)
+    if carriers is None:
+        carriers = estimate_carriers(filename)
+        cache.probe_cache.put("host", filename, carriers)
+    return carriers
+
+
+def host_free_space(filename, bits=2):
+    """Returns how many bytes a host file can hide without decoding it twice."""
+    return carriers_free_space(host_carriers(filename), get_format(filename), bits)
+
+
+def estimate_capacity(filename, bits=2):
+    """Returns how many bytes a host file can hide, reading only its headers."""
+    return carriers_free_space(estimate_carriers(filename), get_format(filename), bits)
+
+
+def carriers_free_space(carriers, file_format, bits=2):
+    if is_jpeg_format(file_format):
+        return max(0, (carriers - 1) * bits // 8)
+    return carriers * bits // 8
+
+
+def estimate_carriers(filename):
+    """Returns the carrier count of a host file from its headers.
+
+    Hosts whose headers cannot be parsed are decoded like HostElement does.
+    """
+    carriers = None
+    if filename.lower().endswith("wav"):
+        start, stop = wav_data_chunk(filename)
+        carriers = stop - start
+    elif filename.lower().endswith("gif"):
+        with Image.open(filename) as image:
+            carriers = image.n_frames * image.size[0] * image.size[1]
+    elif is_jpeg_format(get_format(filename)):
+        carriers = jpeg_header_carriers(filename)
+    else:
+        with Image.open(filename) as image:
+            carriers = image.size[0] * image.size[1] * 3  # converted to RGB
+
+    if carriers is None:
+        host = HostElement(filename)
+        if is_jpeg_format(host.format):
+            carriers = jpeg_carrier_count(host.data)
+        else:
+            carriers = host.data.size
+    return carriers
+
+
+def jpeg_header_carriers(filename):
+    """Returns the AC carrier count of a JPEG from its SOF segment, or None."""
+    with open(filename, "rb") as f:
+        if f.read(2) != b"\xff\xd8":
+            return None
+        while True:
+            prefix = f.read(1)
+            if prefix != b"\xff":
+                return None
+            code = prefix
+            while code == b"\xff":  # fill bytes
+                code = f.read(1)
+            if not code:
+                return None
+            code = code[0]
+            if code == 0x01 or 0xD0 <= code <= 0xD7:  # markers without a length
+                continue
+            if code in (0xD9, 0xDA):  # EOI or SOS before any frame header
+                return None
+
+            length = int.from_bytes(f.read(2), "big")
+            if length < 2:
+                return None
+            if 0xC0 <= code <= 0xCF and code not in (0xC4, 0xC8, 0xCC):
+                return sof_carriers(f.read(length - 2))
+            f.seek(length - 2, os.SEEK_CUR)
+
+
+def sof_carriers(segment):
+    """Counts the AC carriers jpeglib exposes for a SOF segment payload."""
+    if len(segment) < 6:
+        return None
+    height = int.from_bytes(segment[1:3], "big")
+    width = int.from_bytes(segment[3:5], "big")
+    component_count = segment[5]
+    sampling = [
+        (segment[6 + 3 * index + 1] >> 4, segment[6 + 3 * index + 1] & 15)
+        for index in range(component_count)
+        if len(segment) >= 6 + 3 * index + 3
+    ]
+    if not height or not width or len(sampling) != component_count or not sampling:
+        return None
+
+    max_h = max(h for h, _ in sampling)
+    max_v = max(v for _, v in sampling)
+    if not max_h or not max_v:
+        return None
+    used = sampling[:3] if component_count >= 3 else sampling[:1]
+    blocks = sum(
+        -(-width * h // (max_h * 8)) * -(-height * v // (max_v * 8)) for h, v in used
+    )
+    return blocks * 63
+
+
+def print_free_space(filename, bits=2):
+    free = host_free_space(filename, bits)
+    print(
+        "File: {}, free: (bytes) {:,}, encoding: {} bit".format(filename, free, bits)
+    )
+
+
+def get_file(filename, workers=1):
+    """Returns data from file in a list with the header and raw data.
+
+    workers processes quantize the frames of GIFs that need a new palette.
+    """
     if filename.lower().endswith("wav"):
-        content = numpy.fromfile(filename, dtype=numpy.uint8)
-        content = content[:10000], content[10000:]
+        content = get_wav_file(filename)
     elif filename.lower().endswith("gif"):
-        content = get_gif_file(filename)
+        content = get_gif_file(filename, workers)
     elif is_jpeg_format(get_format(filename)):
         jpeg = jpeglib.read_dct(filename)
         content = jpeg, get_jpeg_channels(jpeg)
@@ -245,96 +524,262 @@ def get_file(filename):
     return content
 
 
-def get_gif_file(filename):
-    with preserve_gif_palette_indices():
-        image = Image.open(filename)
-        frames = []
-        durations = []
+def get_wav_file(filename):
+    """Maps a WAV file copy-on-write.
+
+    Returns [mapping, data start] as the header and the data chunk payload,
+    so embedding never loads or modifies the file itself.
+    """
+    start, stop = wav_data_chunk(filename)
+    if os.path.getsize(filename) == 0:
+        sound = numpy.zeros(0, dtype=numpy.uint8)
+    else:
+        sound = numpy.memmap(filename, dtype=numpy.uint8, mode="c")
+    return [sound, start], sound[start:stop]
+
+
+def wav_data_chunk(filename):
+    """Returns the (start, stop) byte range of a WAV file's data chunk payload.
+
+    Files without a RIFF/WAVE data chunk use the legacy 10000-byte header.
+    """
+    with open(filename, "rb") as f:
+        return wav_data_range(f, os.path.getsize(filename))
+
+
+def wav_data_range(f, size):
+    """Finds the data chunk payload in a seekable WAV file object of size bytes."""
+    legacy = (min(size, WAV_LEGACY_HEADER_SIZE), size)
+    f.seek(0)
+    riff = f.read(12)
+    if riff[:4] not in (b"RIFF", b"RF64") or riff[8:12] != b"WAVE":
+        return legacy
+    position = 12
+    while position + 8 <= size:
+        f.seek(position)
+        chunk = f.read(8)
+        chunk_size = int.from_bytes(chunk[4:8], "little")
+        start = position + 8
+        if chunk[:4] == b"data":
+            if riff[:4] == b"RF64" or start + chunk_size > size:
+                return start, size  # size lives in ds64 or the file is cut
+            return start, start + chunk_size
+        position = start + chunk_size + (chunk_size & 1)
+    return legacy
+
+
+def wav_message_data(sound, data_start, data):
+    """Returns the WAV bytes an existing message is read from.
+
+    WAV files written before the data chunk was located carry their message
+    after a fixed 10000-byte header instead.
+    """
+    if data_start == WAV_LEGACY_HEADER_SIZE:
+        return data
+    legacy_data = sound[WAV_LEGACY_HEADER_SIZE:]
+    if not has_embedded_header(data) and has_embedded_header(legacy_data):
+        return legacy_data
+    return data
+
+
+def save_wav_file(source, filename, data_start, data, modified_bytes):
+    """Copies the source WAV and writes back the modified data chunk prefix."""
+    if os.path.abspath(source) != os.path.abspath(filename):
+        shutil.copyfile(source, filename)
+    with open(filename, "r+b") as f:
+        f.seek(data_start)
+        f.write(data[:modified_bytes].tobytes())
+
+
+def save_gif_file(filename, header, frames):
+    """Writes palette index frames to a GIF path or binary file object."""
+    gif = []
+    palette = header[0]
+    for frame in frames:
+        image = Image.fromarray(frame, mode="P")
+        image.putpalette(palette)
+        gif.append(image)
+    gif[0].save(
+        filename,
+        format="GIF",
+        save_all=len(gif) > 1,
+        append_images=gif[1:],
+        loop=header[2],
+        duration=header[1],
+        optimize=False,
+        palette=palette,
+    )
+
+
+def get_gif_file(filename, workers=1):
+    """Returns GIF frames as indices into one normalized palette.
+
+    Pillow's loading strategy is left alone, so frames after the first may
+    arrive as RGB. They are mapped back onto the first palette; only GIFs
+    with colors outside it are quantized to a new palette.
+    """
+    if int(workers) < 1:
+        raise ValueError("GIF workers must be a positive number.")
+    with Image.open(filename) as image:
         palette = image.getpalette()
         loop = image.info.get("loop", 0)
-        try:
-            while True:
-                if image.mode != "P":
-                    break
-                frames.append(numpy.array(image))
-                durations.append(image.info.get("duration", 100))
-                image.seek(image.tell() + 1)
-        except EOFError:
-            frames, palette = normalize_gif_palette(numpy.asarray(frames), palette)
-            return [palette, durations, loop], frames
-
         frame_count = image.n_frames
-        sample_side = max(16, min(96, int((1_000_000 / frame_count) ** 0.5)))
-        sample_pixels = []
+        lookup = None
+        if image.mode == "P":
+            lookup = GifPaletteLookup(palette, image.info.get("transparency"))
+        indexed_frames = []
+        rgb_frames = None
         durations = []
-        image.seek(0)
 
-        for frame_index in range(frame_count):
+        for frame_index in range(frame_count):  # decode each frame once
             image.seek(frame_index)
-            frame = image.convert("RGB")
-            sample = frame.copy()
-            sample.thumbnail((sample_side, sample_side))
-            sample_pixels.append(numpy.asarray(sample).reshape(-1, 3))
             durations.append(image.info.get("duration", 100))
-
-        samples = numpy.concatenate(sample_pixels)
-        palette_image = Image.fromarray(samples.reshape(1, -1, 3), mode="RGB").quantize(
-            colors=256, method=Image.Quantize.MEDIANCUT
-        )
-        palette = palette_image.getpalette()
-        frames = []
-        image.seek(0)
-
-        for frame_index in range(frame_count):
-            image.seek(frame_index)
-            frame = image.convert("RGB").quantize(
-                palette=palette_image, dither=Image.Dither.NONE
+            if rgb_frames is None:
+                frame = lookup.frame_indices(image) if lookup else None
+                if frame is not None:
+                    indexed_frames.append(frame)
+                    continue
+                rgb_frames = allocate_gif_frames(frame_count, image.size)
+                for index, indexed_frame in enumerate(indexed_frames):
+                    rgb_frames[index] = lookup.colors[indexed_frame]
+            rgb_frames[frame_index] = numpy.asarray(
+                image if image.mode == "RGB" else image.convert("RGB")
             )
-            frames.append(numpy.asarray(frame))
 
-        frames, palette = normalize_gif_palette(numpy.asarray(frames), palette)
+    if rgb_frames is None:
+        frames, palette = normalize_gif_palette(numpy.asarray(indexed_frames), palette)
         return [palette, durations, loop], frames
 
+    sample_side = max(16, min(96, int((1_000_000 / frame_count) ** 0.5)))
+    sample_pixels = []
+    for rgb_frame in rgb_frames:
+        sample = Image.fromarray(numpy.asarray(rgb_frame), mode="RGB")
+        sample.thumbnail((sample_side, sample_side))
+        sample_pixels.append(numpy.asarray(sample).reshape(-1, 3))
+
+    # Median cut slows with the number of distinct colors. Rounding samples to
+    # the middle of 5-bit buckets leaves far fewer of them to sort.
+    samples = numpy.concatenate(sample_pixels) & 0xF8 | 0x04
+    palette_image = Image.fromarray(samples.reshape(1, -1, 3), mode="RGB").quantize(
+        colors=256, method=Image.Quantize.MEDIANCUT
+    )
+    palette = palette_image.getpalette()
+    frames = quantize_gif_frames(rgb_frames, palette, int(workers))
+
+    frames, palette = normalize_gif_palette(numpy.asarray(frames), palette)
+    return [palette, durations, loop], frames
+
+
+class GifPaletteLookup:
+    """Maps decoded GIF frames back to indices of the first frame's palette.
+
+    Each color maps to its first palette index, which is also where
+    normalize_gif_palette folds duplicate colors.
+    """
+
+    def __init__(self, palette, transparency=None):
+        palette = list(palette or [])
+        palette = palette[: len(palette) - len(palette) % 3][: 256 * 3]
+        self.colors = numpy.asarray(palette, dtype=numpy.uint8).reshape(-1, 3)
+        keys = gif_color_keys(self.colors)
+        self.keys, first = numpy.unique(keys, return_index=True)
+        self.indices = first.astype(numpy.uint8)
+        self.transparent_index = None
+        if transparency is not None and transparency < len(self.colors):
+            self.transparent_index = self.indices[
+                numpy.searchsorted(self.keys, keys[transparency])
+            ]
+
+    def frame_indices(self, image):
+        """Returns the frame as palette indices, or None if it leaves the palette."""
+        if image.mode == "P":
+            return numpy.array(image)
+        if image.mode not in ("RGB", "RGBA") or not len(self.keys):
+            return None
+        pixels = numpy.asarray(image)
+        keys = gif_color_keys(pixels[..., :3])
+        positions = numpy.minimum(numpy.searchsorted(self.keys, keys), len(self.keys) - 1)
+        frame = self.indices[positions]
+        matched = self.keys[positions] == keys
+        if image.mode == "RGBA":
+            transparent = pixels[..., 3] == 0
+            if transparent.any():
+                if self.transparent_index is None:
+                    return None
+                frame[transparent] = self.transparent_index
+                matched |= transparent
+        if not matched.all():
+            return None
+        return frame
+
+
+def allocate_gif_frames(frame_count, size):
+    """Returns an RGB frame buffer, spilled to a temporary memmap when large."""
+    shape = (frame_count, size[1], size[0], 3)
+    if frame_count * size[0] * size[1] * 3 <= GIF_SPILL_BYTES:
+        return numpy.empty(shape, dtype=numpy.uint8)
+    return numpy.memmap(tempfile.TemporaryFile(), dtype=numpy.uint8, shape=shape)
+
+
+def quantize_gif_frames(rgb_frames, palette, workers=1):
+    """Maps RGB frames onto palette, spreading frames over workers processes."""
+    if workers > 1 and len(rgb_frames) > 1:
+        with ProcessPoolExecutor(workers) as executor:
+            return list(
+                executor.map(
+                    quantize_gif_frame,
+                    rgb_frames,
+                    [palette] * len(rgb_frames),
+                    chunksize=max(1, len(rgb_frames) // (workers * 4)),
+                )
+            )
+    return [quantize_gif_frame(frame, palette) for frame in rgb_frames]
 
-def normalize_gif_palette(frames, palette):
-    palette = list(palette or [])
-    colors = [
-        tuple(palette[index : index + 3])
-        for index in range(0, len(palette) - 2, 3)
-    ][:256]
-    remap = numpy.arange(256, dtype=numpy.uint8)
-    first_index = {}
-    reserved = set()
 
-    for index, color in enumerate(colors):
-        if color in first_index:
-            remap[index] = first_index[color]
-        else:
-            first_index[color] = index
-            reserved.add(color)
+def quantize_gif_frame(rgb_frame, palette):
+    palette_image = Image.new("P", (1, 1))
+    palette_image.putpalette(palette)
+    frame = Image.fromarray(numpy.asarray(rgb_frame), mode="RGB").quantize(
+        palette=palette_image, dither=Image.Dither.NONE
+    )
+    return numpy.asarray(frame)
 
-    frames = remap[frames]
-    normalized = []
-    next_color = 0
 
-    for index in range(256):
-        if index < len(colors) and remap[index] == index:
-            normalized.extend(colors[index])
-            continue
+def normalize_gif_palette(frames, palette):
+    """Folds duplicate palette colors and fills unused slots with new colors.
+
+    Every index of the returned 256-color palette holds a distinct color, and
+    frames are remapped so duplicate indices point at a color's first index.
+    """
+    palette = bytes(palette or b"")
+    count = min(len(palette) // 3, 256)
+    keys = gif_color_keys(
+        numpy.frombuffer(palette[: count * 3], dtype=numpy.uint8).reshape(-1, 3)
+    )
+    unique_keys, first_index = numpy.unique(keys, return_index=True)
+    remap = numpy.arange(256, dtype=numpy.uint8)
+    remap[:count] = first_index[numpy.searchsorted(unique_keys, keys)]
+
+    kept = numpy.zeros(256, dtype=bool)
+    kept[:count] = remap[:count] == numpy.arange(count)
+    free_slots = 256 - int(kept.sum())
+    taken = numpy.zeros(free_slots + len(unique_keys), dtype=bool)
+    taken[unique_keys[unique_keys < len(taken)]] = True
+    fill_keys = numpy.flatnonzero(~taken)[:free_slots]  # smallest unused colors
+
+    normalized = numpy.empty(256, dtype=numpy.int64)
+    normalized[:count][kept[:count]] = keys[kept[:count]]
+    normalized[~kept] = fill_keys
+    normalized = numpy.stack(
+        (normalized >> 16 & 255, normalized >> 8 & 255, normalized & 255), axis=1
+    )
+    return remap[frames], normalized.reshape(-1).tolist()
 
-        while True:
-            color = (
-                next_color >> 16 & 255,
-                next_color >> 8 & 255,
-                next_color & 255,
-            )
-            next_color += 1
-            if color not in reserved:
-                reserved.add(color)
-                normalized.extend(color)
-                break
 
-    return frames, normalized
+def gif_color_keys(colors):
+    """Packs (..., 3) RGB colors into 24-bit integers."""
+    colors = colors.astype(numpy.int32)
+    return colors[..., 0] << 16 | colors[..., 1] << 8 | colors[..., 2]
 
 
 def get_jpeg_channels(jpeg):
@@ -345,18 +790,63 @@ def get_jpeg_channels(jpeg):
 
 
 def get_jpeg_carrier_sets(channels):
-    carrier_sets = []
-    total_carriers = 0
-
-    for channel in channels:
-        flat = channel.reshape(-1)
-        block_count = channel.shape[0] * channel.shape[1]
-        block_bases = (numpy.arange(block_count, dtype=numpy.int64) * 64).reshape(-1, 1)
-        indices = (block_bases + JPEG_ZIGZAG_OFFSETS).reshape(-1)
-        carrier_sets.append((flat, indices))
-        total_carriers += len(indices)
-
-    return carrier_sets, total_carriers
+    """Returns (blocks, 64) views of the channels and their AC carrier count.
+
+    Carriers are the 63 AC coefficients of each block in zigzag order, taken
+    channel after channel. They are addressed through the block views and
+    JPEG_ZIGZAG_OFFSETS, so no per-coefficient index array is built.
+    """
+    carrier_sets = [channel.reshape(-1, 64) for channel in channels]
+    return carrier_sets, jpeg_carrier_count(channels)
+
+
+def jpeg_carrier_count(channels):
+    return sum(channel.shape[0] * channel.shape[1] * 63 for channel in channels)
+
+
+def _jpeg_carrier_windows(carrier_sets, start, stop):
+    """Yields (blocks, first, last, offset, count) windows over carriers start:stop.
+
+    blocks[first:last] holds the carriers, offset is the position of the first
+    requested carrier inside that window and count how many of them it holds.
+    """
+    for blocks in carrier_sets:
+        channel_carriers = len(blocks) * 63
+        if start < channel_carriers and start < stop:
+            channel_stop = min(stop, channel_carriers)
+            first = start // 63
+            last = -(-channel_stop // 63)
+            yield blocks, first, last, start - first * 63, channel_stop - start
+        start = max(0, start - channel_carriers)
+        stop -= channel_carriers
+        if stop <= 0:
+            break
+
+
+def read_jpeg_carriers(carrier_sets, start, stop):
+    """Returns a copy of the coefficients of carriers start:stop."""
+    parts = []
+    for blocks, first, last, offset, count in _jpeg_carrier_windows(
+        carrier_sets, start, stop
+    ):
+        window = blocks[first:last][:, JPEG_ZIGZAG_OFFSETS].reshape(-1)
+        parts.append(window[offset : offset + count])
+    if not parts:
+        return numpy.zeros(0, dtype=numpy.int16)
+    return numpy.concatenate(parts)
+
+
+def write_jpeg_carriers(carrier_sets, start, values):
+    """Writes values into the carriers starting at carrier index start."""
+    position = 0
+    for blocks, first, last, offset, count in _jpeg_carrier_windows(
+        carrier_sets, start, start + len(values)
+    ):
+        window = numpy.ascontiguousarray(blocks[first:last][:, JPEG_ZIGZAG_OFFSETS])
+        flat_window = window.reshape(-1)
+        flat_window[offset : offset + count] = values[position : position + count]
+        blocks[first:last, JPEG_ZIGZAG_OFFSETS] = window
+        position += count
 
 
 def set_jpeg_carrier_value(coeff, value, bits):
@@ -393,6 +883,37 @@ def set_jpeg_carrier_value(coeff, value, bits):
     return sign * target
 
 
+def set_jpeg_carrier_values(coeffs, values, bits):
+    """Vectorized set_jpeg_carrier_value over arrays of coefficients."""
+    abs_coeff = numpy.abs(coeffs.astype(numpy.int32))
+    values = numpy.asarray(values, dtype=numpy.int32)
+    modulus = 2**bits
+
+    lower = numpy.where(
+        abs_coeff >= values, abs_coeff - ((abs_coeff - values) % modulus), values
+    )
+    upper = lower + modulus
+    avoid_zero = values != 0
+    lower = numpy.where(avoid_zero & (lower == 0), lower + modulus, lower)
+    upper = numpy.where(avoid_zero & (upper == 0), upper + modulus, upper)
+
+    lower_distance = numpy.abs(lower - abs_coeff)
+    upper_distance = numpy.abs(upper - abs_coeff)
+    take_upper = (upper_distance < lower_distance) | (
+        (upper_distance == lower_distance) & (upper < lower)
+    )
+    target = numpy.where(take_upper, upper, lower)
+
+    return numpy.where(coeffs < 0, -target, target).astype(coeffs.dtype)
+
+
+def message_chunks(message, bits):
+    """Splits message bytes into bits-wide chunks, least significant first."""
+    data = numpy.frombuffer(bytes(message), dtype=numpy.uint8)
+    shifts = numpy.arange(0, 8, bits, dtype=numpy.uint8)
+    return ((data[:, None] >> shifts) & (2**bits - 1)).reshape(-1)
+
+
 def encode_jpeg_message(channels, message, bits):
     """Encodes a byte array in JPEG DCT coefficients."""
     carrier_sets, total_carriers = get_jpeg_carrier_sets(channels)
@@ -405,61 +926,41 @@ def encode_jpeg_message(channels, message, bits):
 
     check_message_space(max_message_len, len(message))
 
-    first_flat, first_indices = carrier_sets[0]
-    first_flat[first_indices[0]] = set_jpeg_carrier_value(
-        first_flat[first_indices[0]], JPEG_BITS_TO_CODE[bits], 2
-    )
-
-    chunk_mask = 2**bits - 1
-    divisor = 8 // bits
-    payload_chunks = []
-
-    for byte in message:
-        for offset in range(divisor):
-            payload_chunks.append(byte >> bits * offset & chunk_mask)
-
-    chunk_index = 0
-    metadata_written = False
-
-    for flat, indices in carrier_sets:
-        start = 1 if not metadata_written else 0
-        metadata_written = True
+    return encode_jpeg_carriers(channels, carrier_sets, message, bits)
 
-        for index in indices[start:]:
-            if chunk_index >= len(payload_chunks):
-                return channels
 
-            flat[index] = set_jpeg_carrier_value(
-                flat[index], payload_chunks[chunk_index], bits
-            )
-            chunk_index += 1
+def encode_jpeg_carriers(channels, carrier_sets, message, bits):
+    """Writes the bits code and message into carriers that are known to fit."""
+    metadata = read_jpeg_carriers(carrier_sets, 0, 1)
+    metadata[0] = set_jpeg_carrier_value(metadata[0], JPEG_BITS_TO_CODE[bits], 2)
+    write_jpeg_carriers(carrier_sets, 0, metadata)
 
+    payload_chunks = message_chunks(message, bits)
+    carriers = read_jpeg_carriers(carrier_sets, 1, 1 + len(payload_chunks))
+    write_jpeg_carriers(
+        carrier_sets, 1, set_jpeg_carrier_values(carriers, payload_chunks, bits)
+    )
     return channels
 
 
-def decode_jpeg_message(channels):
-    """Decodes JPEG DCT coefficients into a byte array."""
+def decode_jpeg_message(channels, length=None, start=0):
+    """Decodes JPEG DCT coefficients into a byte array.
+
+    Only the carriers of length bytes from start are read when length is given.
+    """
     carrier_sets, total_carriers = get_jpeg_carrier_sets(channels)
     if total_carriers == 0:
         return numpy.zeros(0, dtype=numpy.uint8)
 
-    first_flat, first_indices = carrier_sets[0]
-    bits_code = abs(int(first_flat[first_indices[0]])) & 3
+    bits_code = abs(int(read_jpeg_carriers(carrier_sets, 0, 1)[0])) & 3
     bits = JPEG_CODE_TO_BITS.get(bits_code, 2)
-    chunk_mask = 2**bits - 1
     divisor = 8 // bits
-    chunks = []
-    metadata_read = False
-
-    for flat, indices in carrier_sets:
-        start = 1 if not metadata_read else 0
-        metadata_read = True
-        coeffs = numpy.abs(flat[indices[start:]].astype(numpy.int32))
-        chunks.append((coeffs & chunk_mask).astype(numpy.uint8))
-
-    payload_chunks = (
-        numpy.concatenate(chunks) if chunks else numpy.zeros(0, dtype=numpy.uint8)
-    )
+    first = min(total_carriers, 1 + start * divisor)
+    stop = total_carriers
+    if length is not None:
+        stop = min(stop, first + length * divisor)
+    coeffs = numpy.abs(read_jpeg_carriers(carrier_sets, first, stop))
+    payload_chunks = (coeffs & (2**bits - 1)).astype(numpy.uint8)
     usable_chunks = len(payload_chunks) - (len(payload_chunks) % divisor)
     payload_chunks = payload_chunks[:usable_chunks]
     msg = numpy.zeros(len(payload_chunks) // divisor, dtype=numpy.uint8)
@@ -471,61 +972,258 @@ def decode_jpeg_message(channels):
 
 
 def jpeg_free_space(channels, bits=2):
-    _, total_carriers = get_jpeg_carrier_sets(channels)
-    return max(0, (total_carriers - 1) * bits // 8)
+    return max(0, (jpeg_carrier_count(channels) - 1) * bits // 8)
 
 
 def format_message(message, msg_len, filename=None):
+    return message_header(msg_len, filename) + message
+
+
+def message_header(msg_len, filename=None):
+    """Returns the magic number, length and filename put before a message."""
     if not filename:  # text
-        message = MAGIC_NUMBER + msg_len + (0).to_bytes(1, "big") + message
-    else:
-        filename = filename.encode("utf-8")
-        filename_len = len(filename).to_bytes(1, "big")
-        message = MAGIC_NUMBER + msg_len + filename_len + filename + message
-    return message
+        return MAGIC_NUMBER + msg_len + (0).to_bytes(1, "big")
+    filename = filename.encode("utf-8")
+    filename_len = len(filename).to_bytes(1, "big")
+    return MAGIC_NUMBER + msg_len + filename_len + filename
+
+
+def read_message_header(chunks):
+    """Reads the message header off decrypted chunks.
+
+    Returns the message length, the filename (None for text) and an
+    iterator over the message bytes that follow the header.
+    """
+    chunks = iter(chunks)
+    head = b""
+    while len(head) < 11 or len(head) < 11 + head[10]:
+        chunk = next(chunks, None)
+        if chunk is None:
+            break
+        head += chunk
+    check_magic_number(head)
+    msg_len = int.from_bytes(head[6:10], "big")
+    filename_len = head[10]
+    filename = head[11 : 11 + filename_len].decode("utf-8") if filename_len else None
+
+    def body():
+        yield head[11 + filename_len :]
+        yield from chunks
+
+    return msg_len, filename, body()
+
+
+def limit_chunks(chunks, length):
+    """Yields chunks up to a total of length bytes."""
+    for chunk in chunks:
+        if length <= 0:
+            return
+        yield chunk[:length]
+        length -= len(chunk)
+
+
+def print_text_message(payload):
+    """Prints a decoded text message, or saves it when it is not UTF-8."""
+    try:
+        text = payload.decode("utf-8")
+    except UnicodeDecodeError:
+        filename = "_message.bin"
+        with open(filename, "wb") as f:
+            f.write(payload)
+        print(
+            "Decoded payload is not valid UTF-8; wrote raw bytes to {}".format(
+                filename
+            )
+        )
+        return
+
+    print(text)
+
+
+class MessageReader:
+    """File-like reader over the hidden bytes of a host.
+
+    decode(length, start) returns up to length hidden bytes from start.
+    """
+
+    def __init__(self, decode):
+        self.decode = decode
+        self.offset = 0
+
+    def read(self, size):
+        data = bytes(self.decode(size, self.offset))
+        self.offset += len(data)
+        return data
+
+
+def embedded_message_length(msg, encrypted=False):
+    """Returns how many leading bytes of msg hold the embedded message.
+
+    Returns None while msg is too short to tell. A missing magic number
+    counts as a complete header so callers can stop reading and report it.
+    """
+    if encrypted:
+        return crypt.encrypted_info_length(msg)
+    if len(msg) < 11:
+        return None
+    if bytes(msg[0:6]) != MAGIC_NUMBER:
+        return 11
+    msg_len = int.from_bytes(bytes(msg[6:10]), "big")
+    filename_len = int.from_bytes(bytes(msg[10:11]), "big")
+    return 11 + filename_len + msg_len
+
+
+def has_embedded_header(host_data):
+    """Tells whether host_data starts with a plain or encrypted message."""
+    probe_length = crypt.SALT_SIZE + len(crypt.FERNET_TOKEN_PREFIX)
+    msg = bytes(decode_message(host_data, probe_length))
+    return (
+        msg.startswith(MAGIC_NUMBER)
+        or msg.startswith(crypt.ENVELOPE_MAGIC)
+        or msg[crypt.SALT_SIZE :].startswith(crypt.FERNET_TOKEN_PREFIX)
+    )
+
+
+def read_embedded_message(decode, encrypted=False):
+    """Decodes only the host bytes that hold the embedded message.
+
+    decode(length) returns up to length hidden bytes. The header, or the
+    encrypted envelope header, is read through a doubling window before
+    the rest of the message is decoded in one go.
+    """
+    length = HEADER_PROBE_BYTES
+    while True:
+        msg = decode(length)
+        message_length = embedded_message_length(msg, encrypted)
+        if message_length is not None or len(msg) < length:
+            break
+        length *= 2
+
+    if message_length is None:
+        return msg
+    if message_length > len(msg):
+        msg = decode(message_length)
+    return msg[:message_length]
 
 
 def encode_message(host_data, message, bits):
-    """Encodes the byte array in the image numpy array."""
+    """Encodes the byte array in the image numpy array.
+
+    Only the 8 // bits * len(message) leading host bytes are touched.
+    """
     shape = host_data.shape
     host_data.shape = (-1,)  # convert to 1D
-    uneven = 0
-    divisor = 8 // bits
 
-    print("Host dimension: {:,} bytes".format(host_data.size))
-    print("Message size: {:,} bytes".format(len(message)))
-    print("Maximum size: {:,} bytes".format(host_data.size // divisor))
+    print_message_space(host_data.size, len(message), bits)
 
-    check_message_space(host_data.size // divisor, len(message))
+    encode_message_prefix(host_data, message, bits)
 
-    if (
-        host_data.size % divisor != 0
-    ):  # Hacky way to deal with pixel arrays that cannot be divided evenly
-        uneven = 1
-        original_size = host_data.size
-        host_data = numpy.resize(
-            host_data, host_data.size + (divisor - host_data.size % divisor)
-        )
+    host_data.shape = shape  # restore the 3D shape
 
-    msg = numpy.zeros(len(host_data) // divisor, dtype=numpy.uint8)
+    return host_data
 
-    msg[: len(message)] = list(message)
 
-    host_data[: divisor * len(message)] &= 256 - 2**bits  # clear last bit(s)
-    for i in range(divisor):
-        host_data[i::divisor] |= msg >> bits * i & (
-            2**bits - 1
-        )  # copy bits to host_data
+def encode_message_prefix(host_data, message, bits):
+    """Writes the message bits into the leading bytes of a 1D host array."""
+    encode_message_pieces(host_data, [message], bits)
+
+
+def encode_message_pieces(host_data, pieces, bits):
+    """Writes byte pieces one after another into a 1D host array.
+
+    pieces may be a generator, so a message never has to be joined.
+    """
+    divisor = 8 // bits
+    start = 0
+    for piece in pieces:
+        stop = start + divisor * len(piece)
+        window = host_data[start:stop]
+        window &= 256 - 2**bits  # clear last bit(s)
+        window |= message_chunks(piece, bits)  # copy bits to host_data
+        start = stop
 
     operand = 0 if (bits == 1) else (16 if (bits == 2) else 32)
     host_data[0] = (host_data[0] & 207) | operand  # 5th and 6th bits = log_2(bits)
 
-    if uneven:
-        host_data = numpy.resize(host_data, original_size)
 
-    host_data.shape = shape  # restore the 3D shape
+def print_message_space(host_size, message_len, bits):
+    """Reports host and message sizes and aborts if the message does not fit."""
+    print("Host dimension: {:,} bytes".format(host_size))
+    print("Message size: {:,} bytes".format(message_len))
+    print("Maximum size: {:,} bytes".format(host_size // (8 // bits)))
+
+    check_message_space(host_size // (8 // bits), message_len)
+
+
+def png_carrier_count(info):
+    return info.width * info.height * pngstream.BYTES_PER_PIXEL
+
+
+def png_rows_for(info, host_bytes):
+    row_size = info.width * pngstream.BYTES_PER_PIXEL
+    return min(info.height, max(1, -(-host_bytes // row_size)))
+
+
+def encode_png_message(filename, info, message, bits):
+    """Encodes the byte array in the leading rows of a streamable PNG.
+
+    Only the rows holding the message are decoded. They are returned for
+    pngstream.write_png to splice into the output.
+    """
+    print_message_space(png_carrier_count(info), len(message), bits)
+    rows = pngstream.read_rows(
+        filename, png_rows_for(info, len(message) * (8 // bits)), info
+    )
+    encode_message_prefix(rows.reshape(-1), message, bits)
+    return rows
+
+
+def decode_png_message(filename, info, length=None, start=0):
+    """Decodes a streamable PNG, reading only the rows up to start + length."""
+    if length is None:
+        return decode_message(pngstream.read_image(filename), None, start)
+    rows = pngstream.read_rows(filename, png_rows_for(info, (start + length) * 8), info)
+    return decode_message(rows, length, start)
 
-    return host_data
+
+class PNGMessageDecoder:
+    """Decodes the hidden bytes of a streamable PNG front to back.
+
+    Rows are read in order and dropped once passed, so reading a message in
+    pieces only holds the rows of the current piece.
+    """
+
+    def __init__(self, filename, info):
+        self.filename = filename
+        self.info = info
+        self.rows = pngstream.RowReader(filename, info)
+        self.carriers = self.rows.read(1).reshape(-1)
+        self.offset = 0  # host byte index of carriers[0]
+        self.bits = carrier_bits(self.carriers)
+
+    def decode(self, length=None, start=0):
+        """Decodes length hidden bytes from start, or all of them if None."""
+        divisor = 8 // self.bits
+        first = start * divisor
+        if first < self.offset:
+            self.__init__(self.filename, self.info)
+        stop = png_carrier_count(self.info)
+        if length is not None:
+            stop = min(stop, first + length * divisor)
+        self.drop(first)
+        while self.offset + self.carriers.size < stop:
+            missing = stop - self.offset - self.carriers.size
+            rows = self.rows.read(png_rows_for(self.info, missing))
+            if not len(rows):
+                break
+            self.carriers = numpy.concatenate((self.carriers, rows.reshape(-1)))
+            self.drop(first)
+        return combine_carriers(self.carriers[: max(0, stop - self.offset)], self.bits)
+
+    def drop(self, first):
+        skipped = max(0, min(first - self.offset, self.carriers.size))
+        self.carriers = self.carriers[skipped:]
+        self.offset += skipped
 
 
 def check_message_space(max_message_len, message_len):
@@ -537,15 +1235,32 @@ def check_message_space(max_message_len, message_len):
         print("Ok.")
 
 
-def decode_message(host_data):
-    """Decodes the image numpy array into a byte array."""
+def decode_message(host_data, length=None, start=0):
+    """Decodes the image numpy array into a byte array.
+
+    Only the host bytes of length message bytes from start are read when
+    length is given.
+    """
     host_data = host_data.reshape(-1)  # convert to 1D
     if host_data.size == 0:
         return numpy.zeros(0, dtype=numpy.uint8)
 
-    bits = 2 ** int((int(host_data[0]) & 48) >> 4)  # bits = 2 ^ (5th and 6th bits)
+    bits = carrier_bits(host_data)
     divisor = 8 // bits
+    host_data = host_data[start * divisor :]
+    if length is not None:
+        host_data = host_data[: length * divisor]
+    return combine_carriers(host_data, bits)
+
+
+def carrier_bits(host_data):
+    """Returns the bits per carrier recorded in the first host byte."""
+    return 2 ** int((int(host_data[0]) & 48) >> 4)  # bits = 2 ^ (5th and 6th bits)
 
+
+def combine_carriers(host_data, bits):
+    """Joins the low bits of consecutive carriers into message bytes."""
+    divisor = 8 // bits
     if host_data.size % divisor != 0:
         host_data = numpy.resize(
             host_data, host_data.size + (divisor - host_data.size % divisor)
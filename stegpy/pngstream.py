@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+# Module for streaming the scanlines of 8-bit RGB PNG hosts.
+
+import io
+import itertools
+import shutil
+import struct
+import tempfile
+import zlib
+from dataclasses import dataclass
+
+import numpy
+from PIL import Image
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+READ_SIZE = 1 << 20
+IDAT_SIZE = 1 << 20
+BYTES_PER_PIXEL = 3
+DEFAULT_COMPRESS_LEVEL = 6
+
+
+@dataclass(frozen=True)
+class PNGInfo:
+    width: int
+    height: int
+
+    @property
+    def stride(self):
+        """Bytes per filtered scanline, filter type byte included."""
+        return 1 + self.width * BYTES_PER_PIXEL
+
+
+def read_info(filename):
+    """Returns PNGInfo for an 8-bit RGB non-interlaced PNG, None otherwise."""
+    try:
+        with open(filename, "rb") as f:
+            header = f.read(8 + 8 + 13)
+    except OSError:
+        return None
+    if len(header) < 29 or header[:8] != PNG_SIGNATURE or header[12:16] != b"IHDR":
+        return None
+    width, height, depth, color, compression, filtering, interlace = struct.unpack(
+        ">IIBBBBB", header[16:29]
+    )
+    if (depth, color, compression, filtering, interlace) != (8, 2, 0, 0, 0):
+        return None
+    if not width or not height:
+        return None
+    return PNGInfo(width, height)
+
+
+def iter_chunks(f):
+    """Yields (type, length, data offset) for each chunk, leaving data unread."""
+    f.seek(len(PNG_SIGNATURE))
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        length, chunk_type = struct.unpack(">I4s", header)
+        offset = f.tell()
+        yield chunk_type, length, offset
+        f.seek(offset + length + 4)  # skip data and CRC
+        if chunk_type == b"IEND":
+            return
+
+
+def iter_idat_data(filename):
+    """Yields the compressed image data in pieces of at most READ_SIZE bytes."""
+    with open(filename, "rb") as f:
+        for chunk_type, length, offset in iter_chunks(f):
+            if chunk_type != b"IDAT":
+                continue
+            f.seek(offset)
+            remaining = length
+            while remaining:
+                data = f.read(min(remaining, READ_SIZE))
+                if not data:
+                    raise ValueError("PNG image data is truncated.")
+                remaining -= len(data)
+                yield data
+
+
+def iter_scanlines(filename, info):
+    """Yields the filtered scanlines of a PNG, filter type byte included."""
+    decompressor = zlib.decompressobj()
+    pending = b""
+    produced = 0
+    for data in iter_idat_data(filename):
+        while data:
+            pending += decompressor.decompress(data, READ_SIZE)
+            data = decompressor.unconsumed_tail
+            lines = len(pending) // info.stride
+            for index in range(min(lines, info.height - produced)):
+                yield pending[index * info.stride : (index + 1) * info.stride]
+            produced += lines
+            pending = pending[lines * info.stride :]
+            if produced >= info.height:
+                return
+    raise ValueError("PNG image data is truncated.")
+
+
+def decode_scanlines(info, scanlines):
+    """Unfilters leading scanlines into a (rows, width, 3) array.
+
+    The scanlines are wrapped in a PNG of their own height and decoded by
+    Pillow, since the filters of the first rows never look past them.
+    """
+    if not scanlines:
+        return numpy.zeros((0, info.width, BYTES_PER_PIXEL), dtype=numpy.uint8)
+    output = io.BytesIO()
+    output.write(PNG_SIGNATURE)
+    write_chunk(
+        output,
+        b"IHDR",
+        struct.pack(">IIBBBBB", info.width, len(scanlines), 8, 2, 0, 0, 0),
+    )
+    write_chunk(output, b"IDAT", zlib.compress(b"".join(scanlines), 1))
+    write_chunk(output, b"IEND", b"")
+    output.seek(0)
+    with Image.open(output) as image:
+        return numpy.array(image)
+
+
+def read_rows(filename, count, info=None):
+    """Returns the first count rows of a streamable PNG as a numpy array."""
+    info = info or read_info(filename)
+    scanlines = []
+    if count > 0:
+        for line in iter_scanlines(filename, info):
+            scanlines.append(line)
+            if len(scanlines) >= count:
+                break
+    return decode_scanlines(info, scanlines)
+
+
+class RowReader:
+    """Reads the rows of a streamable PNG front to back, a batch at a time.
+
+    Only the last row read is kept. It is put unfiltered in front of the
+    next batch so that batch's filters can refer to it.
+    """
+
+    def __init__(self, filename, info=None):
+        self.info = info or read_info(filename)
+        self.scanlines = iter_scanlines(filename, self.info)
+        self.previous = None
+
+    def read(self, count):
+        """Returns the next count rows, fewer at the end of the image."""
+        return self.unfilter(list(itertools.islice(self.scanlines, count)))
+
+    def unfilter(self, scanlines):
+        """Decodes scanlines that follow the last ones this reader decoded."""
+        if self.previous is None:
+            rows = decode_scanlines(self.info, scanlines)
+        else:
+            previous = b"\x00" + self.previous.tobytes()
+            rows = decode_scanlines(self.info, [previous] + scanlines)[1:]
+        if len(rows):
+            self.previous = rows[-1]
+        return rows
+
+
+def read_image(filename):
+    with Image.open(filename) as image:
+        return numpy.array(image.convert("RGB"))
+
+
+def write_chunk(f, chunk_type, data):
+    f.write(struct.pack(">I", len(data)))
+    f.write(chunk_type)
+    f.write(data)
+    f.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(chunk_type))))
+
+
+def filter_rows(rows, previous):
+    """Filters rows with the PNG filter of least absolute sum on each row.
+
+    This is libpng's adaptive heuristic. rows is a (count, width * 3) array
+    and previous the unfiltered row above them, or zeros for the first row.
+    Returns the filtered scanlines, filter type bytes included.
+    """
+    rows = rows.astype(numpy.int16)
+    up = numpy.vstack((previous[None].astype(numpy.int16), rows[:-1]))
+    left = numpy.zeros_like(rows)
+    left[:, BYTES_PER_PIXEL:] = rows[:, :-BYTES_PER_PIXEL]
+    up_left = numpy.zeros_like(rows)
+    up_left[:, BYTES_PER_PIXEL:] = up[:, :-BYTES_PER_PIXEL]
+    estimate = left + up - up_left
+    left_distance = numpy.abs(estimate - left)
+    up_distance = numpy.abs(estimate - up)
+    up_left_distance = numpy.abs(estimate - up_left)
+    paeth = numpy.where(
+        (left_distance <= up_distance) & (left_distance <= up_left_distance),
+        left,
+        numpy.where(up_distance <= up_left_distance, up, up_left),
+    )
+    # Filter types 0-4: None, Sub, Up, Average and Paeth.
+    filtered = numpy.stack(
+        (rows, rows - left, rows - up, rows - (left + up) // 2, rows - paeth)
+    ).astype(numpy.uint8)
+    cost = numpy.abs(filtered.view(numpy.int8).astype(numpy.int32)).sum(axis=2)
+    chosen = cost.argmin(axis=0)
+    lines = numpy.empty((len(rows), 1 + rows.shape[1]), dtype=numpy.uint8)
+    lines[:, 0] = chosen
+    lines[:, 1:] = filtered[chosen, numpy.arange(len(rows))]
+    return lines.tobytes()
+
+
+class IDATWriter:
+    """Compresses scanlines into IDAT chunks of about IDAT_SIZE bytes."""
+
+    def __init__(self, output, compress_level):
+        self.output = output
+        self.compressor = zlib.compressobj(compress_level)
+        self.pending = []
+        self.pending_size = 0
+
+    def write(self, data):
+        self.pending.append(self.compressor.compress(data))
+        self.pending_size += len(self.pending[-1])
+        if self.pending_size >= IDAT_SIZE:
+            self.write_chunk()
+
+    def close(self):
+        self.pending.append(self.compressor.flush())
+        self.write_chunk()
+
+    def write_chunk(self):
+        write_chunk(self.output, b"IDAT", b"".join(self.pending))
+        self.pending, self.pending_size = [], 0
+
+
+def write_png(
+    source,
+    target,
+    rows,
+    compress_levels=(DEFAULT_COMPRESS_LEVEL,),
+    adaptive=False,
+):
+    """Streams source to target with its leading rows replaced by rows.
+
+    Replaced rows, and the row after them whose filter may refer to the last
+    one, are written unfiltered. Every other scanline keeps its filter and
+    is recompressed as is, so memory stays bounded by the replaced rows and
+    a batch of scanlines. With several compress_levels, or with adaptive
+    filtering of every row as another candidate, each candidate is
+    compressed to a temporary file and the smallest one is kept.
+    """
+    info = read_info(source)
+    with open(source, "rb") as f, open(target, "wb") as output:
+        output.write(PNG_SIGNATURE)
+        wrote_image_data = False
+        for chunk_type, length, offset in iter_chunks(f):
+            if chunk_type == b"IDAT":
+                if not wrote_image_data:
+                    write_image_data(
+                        output, source, info, rows, compress_levels, adaptive
+                    )
+                    wrote_image_data = True
+                continue
+            f.seek(offset)
+            write_chunk(output, chunk_type, f.read(length))
+
+
+def write_image_data(output, source, info, rows, compress_levels, adaptive):
+    replaced = len(rows)
+    filterings = (False, True) if adaptive else (False,)
+    candidates = [
+        (refilter, level) for refilter in filterings for level in compress_levels
+    ]
+    if len(candidates) == 1:
+        files = [output]
+    else:
+        files = [tempfile.TemporaryFile(prefix="stegpy-") for _ in candidates]
+    writers = [IDATWriter(f, level) for f, (_, level) in zip(files, candidates)]
+
+    reader = RowReader(source, info)
+    batch_size = max(1, READ_SIZE // info.stride)
+    previous = numpy.zeros(info.width * BYTES_PER_PIXEL, dtype=numpy.uint8)
+    index = 0
+    while True:
+        lines = list(itertools.islice(reader.scanlines, batch_size))
+        if not lines:
+            break
+        if adaptive or (replaced and index <= replaced):
+            # Rows are only unfiltered while they are replaced or refiltered.
+            decoded = reader.unfilter(lines).reshape(len(lines), -1)
+            for offset in range(min(len(lines), max(0, replaced - index))):
+                decoded[offset] = rows[index + offset].reshape(-1)
+            lines = [
+                b"\x00" + decoded[offset].tobytes()
+                if replaced and index + offset <= replaced
+                else line
+                for offset, line in enumerate(lines)
+            ]
+        data = {False: b"".join(lines)}
+        if adaptive:
+            data[True] = filter_rows(decoded, previous)
+            previous = decoded[-1]
+        for writer, (refilter, _) in zip(writers, candidates):
+            writer.write(data[refilter])
+        index += len(lines)
+
+    for writer in writers:
+        writer.close()
+    if len(candidates) > 1:
+        smallest = min(files, key=lambda f: f.tell())
+        smallest.seek(0)
+        shutil.copyfileobj(smallest, output)
+        for f in files:
+            f.close()
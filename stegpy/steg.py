@@ -6,8 +6,9 @@ import os.path
 from getpass import getpass
 
 try:
-    from . import lsb, video
+    from . import crypt, lsb, video
 except:
+    import crypt
     import lsb
     import video
 
@@ -37,9 +38,48 @@ def main():
     parser.add_argument(
         "-c", "--check", help="check free space of argument files", action="store_true"
     )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        help="number of processes used to embed video frames or quantize GIF frames (default is 1)",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--save-profile",
+        help="speed/size trade-off of lossless PNG and WebP output (default is {})".format(
+            lsb.DEFAULT_SAVE_PROFILE
+        ),
+        default=lsb.DEFAULT_SAVE_PROFILE,
+        choices=list(lsb.SAVE_PROFILES),
+    )
+    parser.add_argument(
+        "--cipher",
+        help="cipher used with -p; aes-gcm-stream suits large payloads (default is {})".format(
+            crypt.DEFAULT_CIPHER
+        ),
+        default=crypt.DEFAULT_CIPHER,
+        choices=list(crypt.CIPHERS),
+    )
+    parser.add_argument(
+        "--kdf-iterations",
+        help="PBKDF2 iterations used with -p, stored in the payload (default is {})".format(
+            crypt.DEFAULT_ITERATIONS
+        ),
+        type=int,
+        default=crypt.DEFAULT_ITERATIONS,
+    )
     args = parser.parse_args()
 
     bits = int(args.bits)
+    if args.workers < 1:
+        parser.error("argument -w/--workers: must be at least 1")
+    if not crypt.MIN_ITERATIONS <= args.kdf_iterations <= crypt.MAX_ITERATIONS:
+        parser.error(
+            "argument --kdf-iterations: must be between {} and {}".format(
+                crypt.MIN_ITERATIONS, crypt.MAX_ITERATIONS
+            )
+        )
 
     if args.check:
         for arg in args.a + [args.b]:
@@ -47,13 +87,13 @@ def main():
                 if video.is_video_format(lsb.get_format(arg)):
                     video.print_free_space(arg)
                 else:
-                    lsb.HostElement(arg).print_free_space(bits)
+                    lsb.print_free_space(arg, bits)
         return
 
     password = filename = None
     host_path = args.b
     is_video_host = video.is_video_format(lsb.get_format(host_path))
-    host = None if is_video_host else lsb.HostElement(host_path)
+    host = None if is_video_host else lsb.HostElement(host_path, args.workers)
 
     if args.a:
         args.a = args.a[0]
@@ -77,10 +117,20 @@ def main():
                 message,
                 parasite_filename=filename,
                 password=password,
+                workers=args.workers,
+                cipher=args.cipher,
+                iterations=args.kdf_iterations,
             )
         else:
-            host.insert_message(message, bits, filename, password)
-            host.save()
+            host.insert_message(
+                message,
+                bits,
+                filename,
+                password,
+                args.cipher,
+                iterations=args.kdf_iterations,
+            )
+            host.save(profile=args.save_profile)
     else:
         if args.password:
             password = getpass("Enter password (will not be echoed):")
@@ -1,20 +1,26 @@
 #!/usr/bin/env python3
 # Module for robust video steganography through decoded-frame DCT embedding.
 
+import collections
 import contextlib
+import dataclasses
 import json
 import math
+import multiprocessing
 import os
 import shutil
 import subprocess
+import tempfile
+from concurrent.futures import Future, ProcessPoolExecutor
 from dataclasses import dataclass
 from pathlib import Path
 
 import numpy
 
 try:
-    from . import crypt, lsb
+    from . import cache, crypt, lsb
 except:
+    import cache
     import crypt
     import lsb
 
@@ -26,6 +32,9 @@ DEFAULT_CRF = 20
 BLOCK_SIZE = 8
 COEFFICIENT_A = (1, 2)
 COEFFICIENT_B = (2, 1)
+EMBED_STRIP_ROWS = 16
+# probe_video modes whose cached results each mode can reuse, best first.
+PROBE_CACHE_MODES = {True: (True,), None: (None, True), False: (False, None, True)}
 
 
 class VideoProcessingError(RuntimeError):
@@ -38,6 +47,7 @@ class VideoInfo:
     height: int
     fps: str
     frame_count: int
+    exact_frame_count: bool = True
 
 
 def is_video_format(file_format):
@@ -108,7 +118,38 @@ def _rate_as_float(rate):
     return int(numerator) / int(denominator)
 
 
-def probe_video(filename, count_frames=True):
+def probe_video(filename, count_frames=None):
+    """Probe dimensions, frame rate and frame count of a video's first stream.
+
+    By default the frame count is the container's nb_frames, or duration x fps
+    when that is missing, and the stream is only decoded to count frames when
+    neither is available or they disagree. count_frames=True always counts;
+    count_frames=False never does and reports 0 frames when unknown.
+    Results are kept in the probe cache keyed by file content; a probe that
+    counts frames also answers the ones that need less.
+    """
+    for cached_mode in PROBE_CACHE_MODES[count_frames]:
+        cached = cache.probe_cache.get(_probe_namespace(cached_mode), filename)
+        if cached is not None:
+            return VideoInfo(**cached)
+
+    info = _probe_video(filename, count_frames)
+    cache_video_info(filename, info, count_frames)
+    return info
+
+
+def _probe_namespace(count_frames):
+    return "video:{}".format(count_frames)
+
+
+def cache_video_info(filename, info, count_frames=None):
+    """Stores info as the probe_video(filename, count_frames) result."""
+    cache.probe_cache.put(
+        _probe_namespace(count_frames), filename, dataclasses.asdict(info)
+    )
+
+
+def _probe_video(filename, count_frames):
     command = [
         "ffprobe",
         "-v",
@@ -121,7 +162,8 @@ def probe_video(filename, count_frames=True):
     command.extend(
         [
             "-show_entries",
-            "stream=width,height,r_frame_rate,avg_frame_rate,nb_read_frames,nb_frames,duration",
+            "stream=width,height,r_frame_rate,avg_frame_rate,nb_read_frames,nb_frames,duration"
+            ":format=duration",
             "-of",
             "json",
             os.fspath(filename),
@@ -142,13 +184,52 @@ def probe_video(filename, count_frames=True):
     if not width or not height or not fps:
         raise VideoProcessingError("Could not determine video dimensions or frame rate.")
 
-    try:
+    if count_frames:
         frame_count = _stream_frame_count(stream, fps)
-    except VideoProcessingError:
-        if count_frames:
-            raise
-        frame_count = 0
-    return VideoInfo(width=width, height=height, fps=fps, frame_count=frame_count)
+        exact_frame_count = True
+    else:
+        estimate = _estimated_frame_count(stream, fps, data.get("format") or {})
+        if estimate is None and count_frames is None:
+            return probe_video(filename, count_frames=True)
+        frame_count, exact_frame_count = estimate or (0, False)
+
+    return VideoInfo(
+        width=width,
+        height=height,
+        fps=fps,
+        frame_count=frame_count,
+        exact_frame_count=exact_frame_count,
+    )
+
+
+def _estimated_frame_count(stream, fps, container):
+    """Estimate the frame count from stream headers as (count, exact).
+
+    Returns None when the headers give no count or contradict each other.
+    """
+    frame_count = None
+    value = stream.get("nb_frames")
+    if value and str(value).isdigit():
+        frame_count = int(value)
+
+    duration_count = None
+    duration = stream.get("duration") or container.get("duration")
+    fps_value = _rate_as_float(fps)
+    if duration and fps_value:
+        try:
+            duration_count = float(duration) * fps_value
+        except ValueError:
+            pass
+
+    if frame_count and duration_count:
+        if abs(frame_count - duration_count) > 1 + frame_count / 100:
+            return None
+        return frame_count, True
+    if frame_count:
+        return frame_count, True
+    if duration_count:
+        return max(1, math.ceil(round(duration_count, 3))), False
+    return None
 
 
 def _stream_frame_count(stream, fps):
@@ -181,6 +262,16 @@ def _build_dct_matrix(size=BLOCK_SIZE):
 
 DCT_MATRIX = _build_dct_matrix()
 INVERSE_DCT_MATRIX = DCT_MATRIX.T
+# Flattened DCT basis functions of the two carrier coefficients, so extraction
+# needs two dot products per block instead of a full 8x8 transform.
+CARRIER_BASIS = numpy.stack(
+    [
+        numpy.outer(DCT_MATRIX[COEFFICIENT_A[0]], DCT_MATRIX[COEFFICIENT_A[1]]),
+        numpy.outer(DCT_MATRIX[COEFFICIENT_B[0]], DCT_MATRIX[COEFFICIENT_B[1]]),
+    ],
+    axis=-1,
+).reshape(BLOCK_SIZE * BLOCK_SIZE, 2)
+CARRIER_OFFSETS = 128.0 * CARRIER_BASIS.sum(axis=0)
 
 
 def _carrier_count(info):
@@ -228,72 +319,108 @@ def _repeated_bits_to_payload(repeated_bits, repetition):
     return numpy.packbits(bits[:usable_bits]).tobytes()
 
 
+def _frame_luminance(pixels):
+    luminance = pixels[:, :, 0] * 0.299
+    weighted = pixels[:, :, 1] * 0.587
+    luminance += weighted
+    numpy.multiply(pixels[:, :, 2], 0.114, out=weighted)
+    luminance += weighted
+    return luminance
+
+
+def _plane_to_blocks(plane, block_rows, block_columns):
+    """Return the top-left block grid of a plane as an (N, 8, 8) tensor."""
+    return (
+        plane[: block_rows * BLOCK_SIZE, : block_columns * BLOCK_SIZE]
+        .reshape(block_rows, BLOCK_SIZE, block_columns, BLOCK_SIZE)
+        .transpose(0, 2, 1, 3)
+        .reshape(-1, BLOCK_SIZE, BLOCK_SIZE)
+    )
+
+
+def _blocks_to_plane(blocks, block_rows, block_columns):
+    return (
+        blocks.reshape(block_rows, block_columns, BLOCK_SIZE, BLOCK_SIZE)
+        .transpose(0, 2, 1, 3)
+        .reshape(block_rows * BLOCK_SIZE, block_columns * BLOCK_SIZE)
+    )
+
+
 def _embed_bits_in_frame(frame, repeated_bits, bit_index, margin):
-    if bit_index >= len(repeated_bits):
+    """Embed bits into a writable RGB frame in place.
+
+    Returns the frame and the index of the next bit to embed.
+    """
+    block_columns = frame.shape[1] // BLOCK_SIZE
+    block_count = frame.shape[0] // BLOCK_SIZE * block_columns
+    carried = min(block_count, len(repeated_bits) - bit_index)
+    if carried <= 0:
         return frame, bit_index
 
-    pixels = frame.astype(numpy.float32)
-    luminance = (
-        0.299 * pixels[:, :, 0]
-        + 0.587 * pixels[:, :, 1]
-        + 0.114 * pixels[:, :, 2]
+    # Blocks are visited in raster order, so the blocks carrying bits are a
+    # prefix of the block grid. They are transformed a strip of block rows at
+    # a time to keep the float32 temporaries small.
+    carried_rows = -(-carried // block_columns)
+    for first_row in range(0, carried_rows, EMBED_STRIP_ROWS):
+        strip_rows = min(EMBED_STRIP_ROWS, carried_rows - first_row)
+        first_block = first_row * block_columns
+        strip_carried = min(strip_rows * block_columns, carried - first_block)
+        strip_bits = repeated_bits[
+            bit_index + first_block : bit_index + first_block + strip_carried
+        ]
+        top = first_row * BLOCK_SIZE
+        bottom = top + strip_rows * BLOCK_SIZE
+        _embed_bits_in_strip(frame[top:bottom], strip_bits, block_columns, margin)
+
+    return frame, bit_index + carried
+
+
+def _embed_bits_in_strip(strip, strip_bits, block_columns, margin):
+    carried = len(strip_bits)
+    block_rows = strip.shape[0] // BLOCK_SIZE
+    used_width = block_columns * BLOCK_SIZE
+    pixels = strip.astype(numpy.float32)
+    luminance = _frame_luminance(pixels)
+    blocks = _plane_to_blocks(luminance, block_rows, block_columns)[:carried]
+
+    coefficients = DCT_MATRIX @ (blocks - 128.0) @ INVERSE_DCT_MATRIX
+    first = coefficients[:, COEFFICIENT_A[0], COEFFICIENT_A[1]]
+    second = coefficients[:, COEFFICIENT_B[0], COEFFICIENT_B[1]]
+    center = (first + second) / 2.0
+    offset = numpy.where(
+        strip_bits.astype(bool),
+        numpy.float32(margin / 2.0),
+        numpy.float32(-margin / 2.0),
     )
-    used_height = luminance.shape[0] // BLOCK_SIZE * BLOCK_SIZE
-    used_width = luminance.shape[1] // BLOCK_SIZE * BLOCK_SIZE
-
-    for top in range(0, used_height, BLOCK_SIZE):
-        for left in range(0, used_width, BLOCK_SIZE):
-            if bit_index >= len(repeated_bits):
-                encoded = numpy.clip(numpy.rint(pixels), 0, 255)
-                return encoded.astype(numpy.uint8), bit_index
-
-            block = luminance[top : top + BLOCK_SIZE, left : left + BLOCK_SIZE] - 128.0
-            coefficients = DCT_MATRIX @ block @ INVERSE_DCT_MATRIX
-            first = coefficients[COEFFICIENT_A]
-            second = coefficients[COEFFICIENT_B]
-            center = (first + second) / 2.0
-
-            if repeated_bits[bit_index]:
-                coefficients[COEFFICIENT_A] = center + margin / 2.0
-                coefficients[COEFFICIENT_B] = center - margin / 2.0
-            else:
-                coefficients[COEFFICIENT_A] = center - margin / 2.0
-                coefficients[COEFFICIENT_B] = center + margin / 2.0
-
-            updated = INVERSE_DCT_MATRIX @ coefficients @ DCT_MATRIX + 128.0
-            delta = updated - luminance[top : top + BLOCK_SIZE, left : left + BLOCK_SIZE]
-            pixels[top : top + BLOCK_SIZE, left : left + BLOCK_SIZE, :] += delta[
-                :, :, None
-            ]
-            bit_index += 1
-
-    return numpy.clip(numpy.rint(pixels), 0, 255).astype(numpy.uint8), bit_index
-
+    coefficients[:, COEFFICIENT_A[0], COEFFICIENT_A[1]] = center + offset
+    coefficients[:, COEFFICIENT_B[0], COEFFICIENT_B[1]] = center - offset
 
-def _extract_bits_from_frame(frame):
-    pixels = frame.astype(numpy.float32)
-    luminance = (
-        0.299 * pixels[:, :, 0]
-        + 0.587 * pixels[:, :, 1]
-        + 0.114 * pixels[:, :, 2]
+    deltas = numpy.zeros(
+        (block_rows * block_columns, BLOCK_SIZE, BLOCK_SIZE), dtype=numpy.float32
     )
-    used_height = luminance.shape[0] // BLOCK_SIZE * BLOCK_SIZE
-    used_width = luminance.shape[1] // BLOCK_SIZE * BLOCK_SIZE
-    bits = []
-
-    for top in range(0, used_height, BLOCK_SIZE):
-        for left in range(0, used_width, BLOCK_SIZE):
-            block = luminance[top : top + BLOCK_SIZE, left : left + BLOCK_SIZE] - 128.0
-            coefficients = DCT_MATRIX @ block @ INVERSE_DCT_MATRIX
-            bits.append(
-                1 if coefficients[COEFFICIENT_A] > coefficients[COEFFICIENT_B] else 0
-            )
+    deltas[:carried] = INVERSE_DCT_MATRIX @ coefficients @ DCT_MATRIX + 128.0
+    deltas[:carried] -= blocks
+    pixels[:, :used_width, :] += _blocks_to_plane(deltas, block_rows, block_columns)[
+        :, :, None
+    ]
 
-    return bits
+    numpy.clip(numpy.rint(pixels, out=pixels), 0, 255, out=pixels)
+    strip[...] = pixels
 
 
-def _decoder_command(filename):
-    return [
+def _extract_bits_from_frame(frame):
+    """Return the bit carried by every block of a frame as a uint8 array."""
+    block_rows = frame.shape[0] // BLOCK_SIZE
+    block_columns = frame.shape[1] // BLOCK_SIZE
+    pixels = frame[: block_rows * BLOCK_SIZE].astype(numpy.float32)
+    blocks = _plane_to_blocks(_frame_luminance(pixels), block_rows, block_columns)
+    coefficients = blocks.reshape(-1, BLOCK_SIZE * BLOCK_SIZE) @ CARRIER_BASIS
+    coefficients -= CARRIER_OFFSETS
+    return (coefficients[:, 0] > coefficients[:, 1]).view(numpy.uint8)
+
+
+def _decoder_command(filename, frame_limit=None):
+    command = [
         "ffmpeg",
         "-v",
         "error",
@@ -301,12 +428,11 @@ def _decoder_command(filename):
         os.fspath(filename),
         "-map",
         "0:v:0",
-        "-f",
-        "rawvideo",
-        "-pix_fmt",
-        "rgb24",
-        "-",
     ]
+    if frame_limit is not None:
+        command.extend(["-frames:v", str(frame_limit)])
+    command.extend(["-f", "rawvideo", "-pix_fmt", "rgb24", "-"])
+    return command
 
 
 def _encoder_command(input_filename, output_filename, info, crf):
@@ -350,62 +476,255 @@ def _encoder_command(input_filename, output_filename, info, crf):
     ]
 
 
-def encode_payload(
-    input_filename,
-    payload,
-    output_filename=None,
-    repetition=DEFAULT_REPETITION,
-    margin=DEFAULT_MARGIN,
-    crf=DEFAULT_CRF,
-):
-    require_ffmpeg()
-    repetition = _validate_repetition(repetition)
-    input_filename = Path(input_filename)
-    output_filename = (
-        Path(output_filename) if output_filename else prefixed_output_path(input_filename)
+def _segment_encoder_command(output_filename, info, crf):
+    return [
+        "ffmpeg",
+        "-y",
+        "-v",
+        "error",
+        "-f",
+        "rawvideo",
+        "-pix_fmt",
+        "rgb24",
+        "-s",
+        f"{info.width}x{info.height}",
+        "-r",
+        info.fps,
+        "-i",
+        "-",
+        "-c:v",
+        "libx264",
+        "-preset",
+        "medium",
+        "-crf",
+        str(crf),
+        "-pix_fmt",
+        "yuv420p",
+        "-f",
+        "mpegts",
+        os.fspath(output_filename),
+    ]
+
+
+def _tail_copy_command(input_filename, output_filename, start_time):
+    return [
+        "ffmpeg",
+        "-y",
+        "-v",
+        "error",
+        "-ss",
+        f"{start_time:.6f}",
+        "-i",
+        os.fspath(input_filename),
+        "-map",
+        "0:v:0",
+        "-c",
+        "copy",
+        "-bsf:v",
+        "h264_mp4toannexb",
+        "-f",
+        "mpegts",
+        os.fspath(output_filename),
+    ]
+
+
+def _concat_command(listing_filename, input_filename, output_filename):
+    return [
+        "ffmpeg",
+        "-y",
+        "-v",
+        "error",
+        "-f",
+        "concat",
+        "-safe",
+        "0",
+        "-i",
+        os.fspath(listing_filename),
+        "-i",
+        os.fspath(input_filename),
+        "-map",
+        "0:v:0",
+        "-map",
+        "1:a?",
+        "-c:v",
+        "copy",
+        "-c:a",
+        "aac",
+        "-b:a",
+        "128k",
+        "-movflags",
+        "+faststart",
+        "-shortest",
+        os.fspath(output_filename),
+    ]
+
+
+def _run_ffmpeg(command):
+    completed = subprocess.run(
+        command,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        check=False,
     )
-    info = probe_video(input_filename)
-    carriers = _carrier_count(info)
-    max_message_len = carriers // repetition // 8
+    if completed.returncode != 0:
+        error = completed.stderr.decode("utf-8", "replace").strip()
+        raise VideoProcessingError(error or "ffmpeg failed.")
 
-    print("Host dimension: {:,} video DCT carriers".format(carriers))
-    print("Message size: {:,} bytes".format(len(payload)))
-    print("Maximum size: {:,} bytes".format(max_message_len))
-    lsb.check_message_space(max_message_len, len(payload))
 
-    repeated_bits = _payload_to_repeated_bits(payload, repetition)
+def _tail_split_point(filename, info, bit_count):
+    """Find the first keyframe after the payload frames as (frame, seconds).
+
+    Returns None when the stream cannot be stream-copied behind a libx264
+    head or no keyframe follows the frames that carry payload bits.
+    """
+    blocks_per_frame = (info.width // BLOCK_SIZE) * (info.height // BLOCK_SIZE)
+    if not blocks_per_frame:
+        return None
+    frames_needed = -(-bit_count // blocks_per_frame)
+
+    data = _run_json(
+        [
+            "ffprobe",
+            "-v",
+            "error",
+            "-select_streams",
+            "v:0",
+            "-show_entries",
+            "stream=codec_name,pix_fmt:packet=pts_time,flags",
+            "-of",
+            "json",
+            os.fspath(filename),
+        ]
+    )
+    streams = data.get("streams", [])
+    if not streams:
+        return None
+    if streams[0].get("codec_name") != "h264":
+        return None
+    if streams[0].get("pix_fmt") != "yuv420p":
+        return None
+
+    packets = []
+    for packet in data.get("packets", []):
+        try:
+            pts_time = float(packet.get("pts_time"))
+        except (TypeError, ValueError):
+            return None
+        packets.append((pts_time, "K" in packet.get("flags", "")))
+    packets.sort()
+
+    for frame_index, (pts_time, keyframe) in enumerate(packets):
+        if keyframe and frame_index >= max(1, frames_needed):
+            return frame_index, pts_time - packets[0][0]
+    return None
+
+
+def _validate_workers(workers):
+    workers = int(workers)
+    if workers < 1:
+        raise ValueError("Video workers must be a positive number.")
+    return workers
+
+
+def _read_frame_into(stream, buffer):
+    """Fill a preallocated frame buffer from a pipe; returns the bytes read."""
+    view = memoryview(buffer)
+    total = 0
+    while total < len(view):
+        count = stream.readinto(view[total:])
+        if not count:
+            break
+        total += count
+    return total
+
+
+def _embed_frame_bytes(raw_frame, shape, frame_bits, margin):
+    frame = numpy.frombuffer(raw_frame, dtype=numpy.uint8).reshape(shape).copy()
+    _embed_bits_in_frame(frame, frame_bits, 0, margin)
+    return frame.tobytes()
+
+
+def _embed_stream(
+    decoder_command, encoder_command, info, repeated_bits, margin, workers=1
+):
+    """Pipe decoded frames through the embedder into an encoder.
+
+    Every frame starts at a bit offset fixed by its index, so with several
+    workers frames are embedded out of order in a process pool and written
+    back in order. Returns how many repeated bits were embedded; if the
+    frames run out first, the encoder is killed before it finalizes.
+    """
+    frame_shape = (info.height, info.width, 3)
     frame_size = info.width * info.height * 3
+    blocks_per_frame = (info.width // BLOCK_SIZE) * (info.height // BLOCK_SIZE)
+    # Forked workers would inherit the encoder's stdin pipe and keep it open
+    # after the parent closes it, so the pool is spawned instead.
+    executor = (
+        ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"))
+        if workers > 1
+        else None
+    )
     decoder = subprocess.Popen(
-        _decoder_command(input_filename),
+        decoder_command,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
     )
     encoder = subprocess.Popen(
-        _encoder_command(input_filename, output_filename, info, crf),
+        encoder_command,
         stdin=subprocess.PIPE,
         stderr=subprocess.PIPE,
     )
-    bit_index = 0
+    pending = collections.deque()
+    frame_index = 0
+    # Frames are read into one reusable buffer and embedded in place; only
+    # frames handed to the process pool or queued behind it are copied.
+    buffer = bytearray(frame_size)
+    frame = numpy.frombuffer(buffer, dtype=numpy.uint8).reshape(frame_shape)
+
+    def write_frame(frame):
+        if isinstance(frame, Future):
+            frame = frame.result()
+        encoder.stdin.write(frame)
 
     try:
         while True:
-            raw_frame = decoder.stdout.read(frame_size)
-            if not raw_frame:
+            read_size = _read_frame_into(decoder.stdout, buffer)
+            if not read_size:
                 break
-            if len(raw_frame) != frame_size:
+            if read_size != frame_size:
                 raise VideoProcessingError("ffmpeg returned a partial video frame.")
 
-            frame = numpy.frombuffer(raw_frame, dtype=numpy.uint8).reshape(
-                info.height, info.width, 3
-            )
-            frame, bit_index = _embed_bits_in_frame(
-                frame.copy(), repeated_bits, bit_index, margin
+            start = frame_index * blocks_per_frame
+            frame_index += 1
+            frame_bits = repeated_bits[start : start + blocks_per_frame]
+            if not executor:
+                _embed_bits_in_frame(frame, frame_bits, 0, margin)
+                encoder.stdin.write(buffer)
+                continue
+
+            raw_frame = bytes(buffer)
+            if len(frame_bits):
+                raw_frame = executor.submit(
+                    _embed_frame_bytes, raw_frame, frame_shape, frame_bits, margin
+                )
+            pending.append(raw_frame)
+
+            while len(pending) >= 2 * workers:
+                write_frame(pending.popleft())
+
+        decoder_error = decoder.stderr.read().decode("utf-8", "replace").strip()
+        if decoder.wait() != 0:
+            raise VideoProcessingError(decoder_error or "ffmpeg video decode failed.")
+        if frame_index * blocks_per_frame < len(repeated_bits):
+            # The probed frame count overstated the stream.
+            raise VideoProcessingError(
+                "Video ended before the full payload was embedded."
             )
-            encoder.stdin.write(frame.tobytes())
+
+        while pending:
+            write_frame(pending.popleft())
 
         encoder.stdin.close()
-        decoder_error = decoder.stderr.read().decode("utf-8", "replace").strip()
-        decoder_return = decoder.wait()
         encoder_error = encoder.stderr.read().decode("utf-8", "replace").strip()
         encoder_return = encoder.wait()
     except Exception:
@@ -414,19 +733,136 @@ def encode_payload(
         with contextlib.suppress(Exception):
             encoder.kill()
         raise
+    finally:
+        if executor:
+            executor.shutdown()
 
-    if decoder_return != 0:
-        raise VideoProcessingError(decoder_error or "ffmpeg video decode failed.")
     if encoder_return != 0:
         raise VideoProcessingError(encoder_error or "ffmpeg video encode failed.")
-    if bit_index < len(repeated_bits):
-        raise VideoProcessingError("Video ended before the full payload was embedded.")
+    return len(repeated_bits)
 
+
+def _encode_head_and_copy_tail(
+    input_filename, output_filename, info, repeated_bits, margin, crf, split, workers
+):
+    split_frame, split_time = split
+    # Seek half a frame past the keyframe so float formatting can never land
+    # the stream copy on the previous keyframe.
+    seek_time = split_time + 0.5 / _rate_as_float(info.fps)
+
+    with tempfile.TemporaryDirectory(prefix="stegpy-") as workdir:
+        workdir = Path(workdir)
+        head = workdir / "head.ts"
+        tail = workdir / "tail.ts"
+        listing = workdir / "segments.txt"
+
+        _embed_stream(
+            _decoder_command(input_filename, frame_limit=split_frame),
+            _segment_encoder_command(head, info, crf),
+            info,
+            repeated_bits,
+            margin,
+            workers,
+        )
+        _run_ffmpeg(_tail_copy_command(input_filename, tail, seek_time))
+        listing.write_text(
+            "file '{}'\nfile '{}'\n".format(head.as_posix(), tail.as_posix())
+        )
+        _run_ffmpeg(_concat_command(listing, input_filename, output_filename))
+
+
+def encode_payload(
+    input_filename,
+    payload,
+    output_filename=None,
+    repetition=DEFAULT_REPETITION,
+    margin=DEFAULT_MARGIN,
+    crf=DEFAULT_CRF,
+    copy_tail=False,
+    workers=1,
+):
+    """Embed payload into a video and write it as MP4/H.264.
+
+    With copy_tail, only the leading GOPs that carry payload bits are
+    re-encoded and the rest of an H.264 host is stream-copied behind them.
+    Hosts that cannot be split that way are fully re-encoded. workers sets
+    how many processes embed frames in parallel.
+    """
+    require_ffmpeg()
+    repetition = _validate_repetition(repetition)
+    workers = _validate_workers(workers)
+    input_filename = Path(input_filename)
+    output_filename = (
+        Path(output_filename) if output_filename else prefixed_output_path(input_filename)
+    )
+    info = probe_video(input_filename)
+    carriers = _carrier_count(info)
+    max_message_len = carriers // repetition // 8
+    if max_message_len < len(payload) and not info.exact_frame_count:
+        # Duration-based estimates can undercount; only a real count may abort.
+        info = probe_video(input_filename, count_frames=True)
+        carriers = _carrier_count(info)
+        max_message_len = carriers // repetition // 8
+
+    print("Host dimension: {:,} video DCT carriers".format(carriers))
+    print("Message size: {:,} bytes".format(len(payload)))
+    print("Maximum size: {:,} bytes".format(max_message_len))
+    lsb.check_message_space(max_message_len, len(payload))
+
+    repeated_bits = _payload_to_repeated_bits(payload, repetition)
+    split = None
+    if copy_tail:
+        split = _tail_split_point(input_filename, info, len(repeated_bits))
+
+    if split is not None:
+        print(
+            "Re-encoding the first {:,} of {:,} frames.".format(
+                split[0], info.frame_count
+            )
+        )
+    try:
+        if split is None:
+            _embed_stream(
+                _decoder_command(input_filename),
+                _encoder_command(input_filename, output_filename, info, crf),
+                info,
+                repeated_bits,
+                margin,
+                workers,
+            )
+        else:
+            _encode_head_and_copy_tail(
+                input_filename,
+                output_filename,
+                info,
+                repeated_bits,
+                margin,
+                crf,
+                split,
+                workers,
+            )
+    except Exception:
+        # Never leave a partial or payload-less output behind.
+        with contextlib.suppress(OSError):
+            output_filename.unlink()
+        raise
+
+    # Decoding only needs the dimensions and frame rate, which the output keeps.
+    output_info = dataclasses.replace(info, exact_frame_count=False)
+    cache_video_info(output_filename, output_info, count_frames=False)
     print("Information encoded in {}.".format(output_filename))
     return output_filename
 
 
-def decode_payload(input_filename, repetition=DEFAULT_REPETITION):
+def decode_payload(
+    input_filename, repetition=DEFAULT_REPETITION, stop_early=False, encrypted=False
+):
+    """Decode the repeated-bit payload carried by a video.
+
+    With stop_early, bits are majority-voted as frames arrive and the ffmpeg
+    decoder is stopped as soon as the embedded message (or, when encrypted,
+    the encrypted envelope) is complete. Only those bytes are returned.
+    """
     require_ffmpeg()
     repetition = _validate_repetition(repetition)
     info = probe_video(input_filename, count_frames=False)
@@ -436,30 +872,47 @@ def decode_payload(input_filename, repetition=DEFAULT_REPETITION):
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
     )
-    extracted_bits = []
+    group_size = 8 * repetition
+    pending_bits = numpy.zeros(0, dtype=numpy.uint8)
+    payload = bytearray()
+    message_length = None
+
+    buffer = bytearray(frame_size)
+    frame = numpy.frombuffer(buffer, dtype=numpy.uint8).reshape(
+        info.height, info.width, 3
+    )
 
-    while True:
-        raw_frame = decoder.stdout.read(frame_size)
-        if not raw_frame:
-            break
-        if len(raw_frame) != frame_size:
-            decoder.kill()
-            raise VideoProcessingError("ffmpeg returned a partial video frame.")
-        frame = numpy.frombuffer(raw_frame, dtype=numpy.uint8).reshape(
-            info.height, info.width, 3
-        )
-        extracted_bits.extend(_extract_bits_from_frame(frame))
+    try:
+        while True:
+            read_size = _read_frame_into(decoder.stdout, buffer)
+            if not read_size:
+                break
+            if read_size != frame_size:
+                raise VideoProcessingError("ffmpeg returned a partial video frame.")
+            pending_bits = numpy.concatenate(
+                (pending_bits, _extract_bits_from_frame(frame))
+            )
+            usable = len(pending_bits) - (len(pending_bits) % group_size)
+            payload += _repeated_bits_to_payload(pending_bits[:usable], repetition)
+            pending_bits = pending_bits[usable:]
 
-    decoder_error = decoder.stderr.read().decode("utf-8", "replace").strip()
-    decoder_return = decoder.wait()
-    if decoder_return != 0:
-        raise VideoProcessingError(decoder_error or "ffmpeg video decode failed.")
+            if not stop_early:
+                continue
+            if message_length is None:
+                message_length = lsb.embedded_message_length(payload, encrypted)
+            if message_length is not None and len(payload) >= message_length:
+                return bytes(payload[:message_length])
 
-    if not extracted_bits:
-        return b""
-    return _repeated_bits_to_payload(
-        numpy.asarray(extracted_bits, dtype=numpy.uint8), repetition
-    )
+        decoder_error = decoder.stderr.read().decode("utf-8", "replace").strip()
+        if decoder.wait() != 0:
+            raise VideoProcessingError(decoder_error or "ffmpeg video decode failed.")
+    finally:
+        # Stops a decoder left running by an early return or a parsing error.
+        with contextlib.suppress(Exception):
+            decoder.kill()
+        decoder.wait()
+
+    return bytes(payload)
 
 
 def insert_message(
@@ -469,21 +922,35 @@ def insert_message(
     password=None,
     output_filename=None,
     repetition=DEFAULT_REPETITION,
+    copy_tail=False,
+    workers=1,
+    cipher=crypt.DEFAULT_CIPHER,
+    kdf=crypt.DEFAULT_KDF,
+    iterations=crypt.DEFAULT_ITERATIONS,
 ):
     raw_message_len = len(message).to_bytes(4, "big")
     formatted_message = lsb.format_message(message, raw_message_len, parasite_filename)
     if password:
-        formatted_message = crypt.encrypt_info(password, formatted_message)
+        formatted_message = crypt.encrypt_info(
+            password, formatted_message, cipher, kdf, iterations
+        )
     return encode_payload(
         input_filename,
         formatted_message,
         output_filename=output_filename,
         repetition=repetition,
+        copy_tail=copy_tail,
+        workers=workers,
     )
 
 
 def read_message(input_filename, password=None, repetition=DEFAULT_REPETITION):
-    msg = decode_payload(input_filename, repetition=repetition)
+    msg = decode_payload(
+        input_filename,
+        repetition=repetition,
+        stop_early=True,
+        encrypted=bool(password),
+    )
 
     if password:
         try:
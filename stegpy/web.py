@@ -1,3 +1,4 @@
+import functools
 import re
 import shutil
 import sys
@@ -11,7 +12,7 @@ from fastapi.staticfiles import StaticFiles
 from starlette.background import BackgroundTask
 from starlette.concurrency import run_in_threadpool
 
-from . import crypt, lsb, video
+from . import api, crypt, lsb, video
 
 
 APP_ROOT = Path(__file__).resolve().parent.parent
@@ -41,6 +42,8 @@ MAX_VIDEO_HOST_BYTES = 5 * 1024 * 1024
 MAX_PAYLOAD_BYTES = 20 * 1024 * 1024
 MAX_MESSAGE_BYTES = 1 * 1024 * 1024
 PAYLOAD_HEADER_BYTES = 11
+WEB_KDF_SECONDS = 0.05  # password key derivation time when decoding in the demo
+WEB_MAX_KDF_FACTOR = 4  # uploads may ask for this many times the demo's cost
 
 app = FastAPI(title="stegpy demo")
 
@@ -61,6 +64,29 @@ def validate_bits(bits):
     return bits
 
 
+def validate_save_profile(profile):
+    if profile not in lsb.SAVE_PROFILES:
+        profiles = ", ".join(lsb.SAVE_PROFILES)
+        raise HTTPException(
+            status_code=400, detail=f"Save profile must be one of: {profiles}."
+        )
+    return profile
+
+
+@functools.lru_cache(maxsize=None)
+def web_kdf_iterations():
+    """PBKDF2 iterations for demo payloads, calibrated once per process."""
+    return crypt.calibrate_iterations(WEB_KDF_SECONDS)
+
+
+def web_max_kdf_iterations():
+    """Most PBKDF2 iterations an uploaded payload may make the demo run.
+
+    Payloads written with the CLI default are always accepted.
+    """
+    return max(crypt.DEFAULT_ITERATIONS, WEB_MAX_KDF_FACTOR * web_kdf_iterations())
+
+
 def validate_host_name(filename):
     extension = host_extension(filename)
     if extension not in SUPPORTED_HOST_EXTENSIONS:
@@ -135,10 +161,8 @@ async def save_upload(upload, directory, max_bytes, fallback):
     return path
 
 
-def decode_payload(host):
-    if lsb.is_jpeg_format(host.format):
-        return lsb.decode_jpeg_message(host.data)
-    return lsb.decode_message(host.data)
+def decode_payload(host, encrypted=False):
+    return lsb.read_embedded_message(host.decode, encrypted)
 
 
 def is_video_host(path_or_filename):
@@ -168,33 +192,11 @@ def host_upload_limit(filename):
 
 
 def parse_message(raw_message, password):
-    message = raw_message
-    if password:
-        try:
-            message = crypt.decrypt_embedded_info(password, message)
-        except Exception as exc:
-            raise HTTPException(status_code=400, detail="Wrong password.") from exc
-
-    if len(message) < 11 or bytes(message[:6]) != lsb.MAGIC_NUMBER:
-        raise HTTPException(
-            status_code=400,
-            detail="No stegpy payload was found in this host file.",
-        )
-
-    payload_length = int.from_bytes(bytes(message[6:10]), "big")
-    filename_length = int.from_bytes(bytes(message[10:11]), "big")
-    filename_start = 11
-    payload_start = filename_start + filename_length
-    payload_end = payload_start + payload_length
-
-    if payload_end > len(message):
-        raise HTTPException(status_code=400, detail="The stegpy payload is incomplete.")
-
-    embedded_filename = ""
-    if filename_length:
-        embedded_filename = bytes(message[filename_start:payload_start]).decode("utf-8")
-
-    return embedded_filename, bytes(message[payload_start:payload_end])
+    try:
+        extracted = api.parse_payload(raw_message, password, web_max_kdf_iterations())
+    except api.StegpyError as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
+    return extracted.filename or "", extracted.payload
 
 
 def run_processing(callback):
@@ -236,7 +238,7 @@ async def capacity(
         def calculate():
             if is_video_host(host_path):
                 return video.video_free_space(str(host_path))
-            return lsb.HostElement(str(host_path)).free_space(bits)
+            return lsb.host_free_space(str(host_path), bits)
 
         carrier_bytes = await run_in_threadpool(run_processing, calculate)
         capacity_bytes = usable_payload_capacity(
@@ -268,8 +270,10 @@ async def encode(
     payload: Optional[UploadFile] = File(None),
     bits: int = Form(2),
     password: str = Form(""),
+    save_profile: str = Form(lsb.DEFAULT_SAVE_PROFILE),
 ):
     validate_bits(bits)
+    validate_save_profile(save_profile)
     validate_host_name(host.filename)
     validate_video_web_access(host.filename, request)
     workdir = Path(tempfile.mkdtemp(prefix="stegpy-"))
@@ -306,6 +310,7 @@ async def encode(
                     parasite_filename=embedded_filename,
                     password=password or None,
                     output_filename=output_path,
+                    iterations=web_kdf_iterations(),
                 )
 
             element = lsb.HostElement(str(host_path))
@@ -314,9 +319,10 @@ async def encode(
                 bits=bits,
                 parasite_filename=embedded_filename,
                 password=password or None,
+                iterations=web_kdf_iterations(),
             )
             output_path = workdir / f"_{host_path.name}"
-            element.save(output_path)
+            element.save(output_path, profile=save_profile)
             return Path(element.filename)
 
         output_path = await run_in_threadpool(run_processing, encode_file)
@@ -349,11 +355,18 @@ async def decode(
         def extract():
             if is_video_host(host_path):
                 return parse_message(
-                    video.decode_payload(str(host_path)), password or None
+                    video.decode_payload(
+                        str(host_path),
+                        stop_early=True,
+                        encrypted=bool(password),
+                    ),
+                    password or None,
                 )
 
             element = lsb.HostElement(str(host_path))
-            return parse_message(decode_payload(element), password or None)
+            return parse_message(
+                decode_payload(element, bool(password)), password or None
+            )
 
         embedded_filename, payload_bytes = await run_in_threadpool(
             run_processing, extract
@@ -0,0 +1,115 @@
+import io
+import wave
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import stegpy
+from stegpy import lsb
+from stegpy.lsb import HostElement
+
+
+def create_rgb_host(path, size=(64, 64)):
+    pixels = np.arange(size[0] * size[1] * 3) % 251
+    Image.fromarray(pixels.astype(np.uint8).reshape(size[1], size[0], 3)).save(path)
+
+
+def create_jpeg_host(path, size=(128, 128)):
+    y, x = np.mgrid[: size[1], : size[0]]
+    pixels = np.stack([(x * 7 + y * 13) % 256, (x * 11) ^ (y * 5), x * y % 31], -1)
+    Image.fromarray((pixels % 256).astype(np.uint8)).save(path, quality=95)
+
+
+def create_gif_host(path):
+    frames = [Image.new("RGB", (24, 24), color) for color in ("red", "lime")]
+    frames[0].save(path, save_all=True, append_images=frames[1:], optimize=False)
+
+
+def create_wav_host(path, frames=6000):
+    with wave.open(str(path), "wb") as sound:
+        sound.setnchannels(1)
+        sound.setsampwidth(2)
+        sound.setframerate(8000)
+        sound.writeframes(np.arange(frames, dtype="<i2").tobytes())
+
+
+HOSTS = {
+    "png": create_rgb_host,
+    "bmp": create_rgb_host,
+    "gif": create_gif_host,
+    "wav": create_wav_host,
+    "jpg": create_jpeg_host,
+}
+
+
+def host_bytes(tmp_path, fmt):
+    path = tmp_path / ("host." + fmt)
+    HOSTS[fmt](path)
+    return path.read_bytes()
+
+
+@pytest.mark.parametrize("fmt", sorted(HOSTS))
+def test_embed_extract_round_trip(tmp_path, capsys, fmt):
+    host = host_bytes(tmp_path, fmt)
+
+    output = stegpy.embed(host, fmt, b"in memory", filename="dir/note.txt")
+    extracted = stegpy.extract(output, fmt)
+
+    assert extracted == stegpy.ExtractedPayload(b"in memory", "note.txt")
+    assert capsys.readouterr().out == ""
+
+
+@pytest.mark.parametrize("fmt", ["png", "wav", "jpg"])
+def test_embedded_bytes_are_readable_by_host_element(tmp_path, capsys, fmt):
+    output = stegpy.embed(host_bytes(tmp_path, fmt), fmt, b"shared format")
+    (tmp_path / ("out." + fmt)).write_bytes(output)
+
+    host = HostElement(str(tmp_path / ("out." + fmt)))
+    message = bytes(lsb.read_embedded_message(host.decode))
+
+    assert message[11:] == b"shared format"
+
+
+def test_file_objects_and_passwords(tmp_path):
+    host = io.BytesIO(host_bytes(tmp_path, "png"))
+
+    output = stegpy.embed(host, "PNG", b"secret", password="hunter2")
+
+    assert stegpy.extract(io.BytesIO(output), "png", password="hunter2").payload == (
+        b"secret"
+    )
+    with pytest.raises(stegpy.DecryptionError):
+        stegpy.extract(output, "png", password="wrong")
+
+
+@pytest.mark.parametrize("fmt", ["png", "jpg"])
+def test_aes_gcm_payloads_are_detected_on_extract(tmp_path, fmt):
+    host = host_bytes(tmp_path, fmt)
+
+    output = stegpy.embed(host, fmt, b"aead", password="pw", cipher="aes-gcm")
+
+    assert stegpy.extract(output, fmt, password="pw").payload == b"aead"
+    with pytest.raises(ValueError):
+        stegpy.embed(host, fmt, b"aead", password="pw", cipher="rot13")
+
+
+def test_capacity_errors_are_raised_instead_of_exiting(tmp_path):
+    host = host_bytes(tmp_path, "png")
+    capacity = stegpy.capacity(host, "png", bits=2)
+    header = len(lsb.MAGIC_NUMBER) + 5
+
+    stegpy.embed(host, "png", b"x" * (capacity - header))
+    with pytest.raises(stegpy.CapacityError):
+        stegpy.embed(host, "png", b"x" * (capacity - header + 1))
+
+
+def test_missing_payload_and_unsupported_format(tmp_path):
+    host = host_bytes(tmp_path, "png")
+
+    with pytest.raises(stegpy.PayloadNotFoundError):
+        stegpy.extract(host, "png")
+    with pytest.raises(stegpy.UnsupportedFormatError):
+        stegpy.embed(host, "mp4", b"video")
+    with pytest.raises(ValueError):
+        stegpy.embed(host, "png", b"bits", bits=3)
@@ -0,0 +1,105 @@
+import os
+
+import numpy as np
+from PIL import Image
+
+from stegpy import cache, lsb
+
+
+def create_rgb_host(path, size=(32, 32)):
+    pixels = np.arange(size[0] * size[1] * 3, dtype=np.uint8).reshape(
+        size[1], size[0], 3
+    )
+    Image.fromarray(pixels).save(path)
+
+
+def test_file_key_changes_when_file_changes(tmp_path):
+    path = tmp_path / "host.bin"
+    path.write_bytes(b"first")
+    first = cache.file_key(path)
+
+    path.write_bytes(b"second")
+    os.utime(path, ns=(0, 0))
+
+    assert cache.file_key(path) != first
+    assert cache.file_key(tmp_path / "missing.bin") is None
+
+
+def test_file_key_is_shared_by_copies_of_the_same_host(tmp_path):
+    content = bytes(range(256)) * 1024
+    (tmp_path / "host.mp4").write_bytes(content)
+    (tmp_path / "upload.mp4").write_bytes(content)
+    (tmp_path / "upload.mkv").write_bytes(content)
+    (tmp_path / "tail.mp4").write_bytes(content[:-1] + b"\x00")
+
+    key = cache.file_key(tmp_path / "host.mp4")
+
+    assert cache.file_key(tmp_path / "upload.mp4") == key
+    assert cache.file_key(tmp_path / "upload.mkv") != key
+    assert cache.file_key(tmp_path / "tail.mp4") != key
+
+
+def test_metadata_cache_evicts_least_recently_used(tmp_path):
+    metadata = cache.MetadataCache(maxsize=2)
+    paths = []
+    for index in range(3):
+        path = tmp_path / f"{index}.bin"
+        path.write_bytes(bytes([index]))
+        paths.append(path)
+
+    metadata.put("host", paths[0], 0)
+    metadata.put("host", paths[1], 1)
+    assert metadata.get("host", paths[0]) == 0
+    metadata.put("host", paths[2], 2)
+
+    assert metadata.get("host", paths[0]) == 0
+    assert metadata.get("host", paths[1]) is None
+    assert metadata.get("host", paths[2]) == 2
+
+
+def test_metadata_cache_reads_back_from_disk_store(tmp_path):
+    path = tmp_path / "host.bin"
+    path.write_bytes(b"host")
+    cache.MetadataCache(directory=tmp_path / "store").put("video", path, {"a": 1})
+
+    assert cache.MetadataCache(directory=tmp_path / "store").get("video", path) == {
+        "a": 1
+    }
+
+
+def test_host_free_space_skips_probing_cached_hosts(tmp_path, monkeypatch):
+    create_rgb_host(tmp_path / "host.png", size=(41, 37))
+    host = lsb.HostElement(str(tmp_path / "host.png"))
+    expected = host.free_space(2)
+    expected_four_bits = host.free_space(4)
+    probed = []
+    estimate_carriers = lsb.estimate_carriers
+
+    def counting_estimate(filename):
+        probed.append(filename)
+        return estimate_carriers(filename)
+
+    monkeypatch.setattr(lsb, "estimate_carriers", counting_estimate)
+
+    assert lsb.host_free_space(str(tmp_path / "host.png"), 2) == expected
+    assert lsb.host_free_space(str(tmp_path / "host.png"), 2) == expected
+    assert lsb.host_free_space(str(tmp_path / "host.png"), 4) == expected_four_bits
+    assert probed == [str(tmp_path / "host.png")]
+
+
+def test_key_cache_zeroes_evicted_and_expired_keys(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now[0])
+    keys = cache.KeyCache(maxsize=2, ttl=10)
+    keys.put(b"a", b"\x01" * 4)
+    stored = keys.entries[b"a"][1]
+    keys.put(b"b", b"\x02" * 4)
+    keys.put(b"c", b"\x03" * 4)
+
+    assert keys.get(b"a") is None
+    assert stored == bytearray(4)
+
+    stored = keys.entries[b"b"][1]
+    now[0] = 111.0
+    assert keys.get(b"b") is None
+    assert stored == bytearray(4)
@@ -82,3 +82,53 @@ def test_cli_check_reports_selected_bit_depth(tmp_path, monkeypatch, capsys):
 
     assert "File: host.png, free: (bytes)" in output
     assert "encoding: 1 bit" in output
+
+
+def test_cli_save_profile_controls_webp_output(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    create_rgb_host("host.png")
+    Image.open("host.png").save("host.webp", lossless=True)
+    saved = []
+    original_save = Image.Image.save
+
+    def save(image, filename, *args, **kwargs):
+        saved.append(kwargs)
+        return original_save(image, filename, *args, **kwargs)
+
+    monkeypatch.setattr(Image.Image, "save", save)
+    monkeypatch.setattr(
+        sys, "argv", ["stegpy", "fast", "host.webp", "--save-profile", "fast"]
+    )
+    steg.main()
+    capsys.readouterr()
+
+    assert saved == [{"lossless": True, "method": 0, "quality": 0}]
+
+    monkeypatch.setattr(sys, "argv", ["stegpy", "_host.webp"])
+    steg.main()
+    assert "fast" in capsys.readouterr().out
+
+    # Lossless WebP has two tiers, so the default small profile saves like
+    # balanced, which is also Pillow's default effort.
+    monkeypatch.setattr(sys, "argv", ["stegpy", "default", "host.webp"])
+    steg.main()
+    assert saved[-1] == {"lossless": True, "method": 4, "quality": 80}
+
+
+def test_cli_aes_gcm_password_round_trip(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    create_rgb_host("host.png")
+    monkeypatch.setattr(steg, "getpass", lambda prompt: "hunter2")
+
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        ["stegpy", "binary envelope", "host.png", "-p", "--cipher", "aes-gcm"],
+    )
+    steg.main()
+    capsys.readouterr()
+
+    monkeypatch.setattr(sys, "argv", ["stegpy", "_host.png", "-p"])
+    steg.main()
+
+    assert "binary envelope" in capsys.readouterr().out
@@ -1,11 +1,24 @@
+import pytest
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet, InvalidToken
+
 from stegpy import crypt
 
 
+def legacy_encrypt_info(password, info):
+    key, salt = crypt.derive_key(password.encode("utf-8"))
+    return salt + Fernet(key).encrypt(info)
+
+
 def test_encrypt_and_decrypt_round_trip():
-    token = crypt.encrypt_info("hunter2", b"hidden message")
-    salt = token[:16]
+    envelope = crypt.encrypt_info("hunter2", b"hidden message", crypt.FERNET)
+    block = envelope[crypt.ENVELOPE_HEADER.size :][: crypt.key_block_size()]
+    kdf_header, salt = block[: crypt.KDF_HEADER.size], block[crypt.KDF_HEADER.size :]
+    token = envelope[crypt.ENVELOPE_HEADER.size + len(block) :]
 
-    assert crypt.decrypt_info("hunter2", token[16:], salt) == b"hidden message"
+    assert envelope.startswith(crypt.ENVELOPE_MAGIC)
+    assert crypt.KDF_HEADER.unpack(kdf_header) == (1, crypt.DEFAULT_ITERATIONS)
+    assert crypt.decrypt_info("hunter2", token, salt) == b"hidden message"
 
 
 def test_encrypt_info_uses_random_salt():
@@ -17,9 +30,9 @@ def test_encrypt_info_uses_random_salt():
 
 def test_encrypted_info_size_matches_fernet_output():
     for info_length in [0, 1, 15, 16, 17, 100, 245, 246]:
-        encrypted = crypt.encrypt_info("hunter2", b"x" * info_length)
+        encrypted = crypt.encrypt_info("hunter2", b"x" * info_length, crypt.FERNET)
 
-        assert crypt.encrypted_info_size(info_length) == len(encrypted)
+        assert crypt.encrypted_info_size(info_length, crypt.FERNET) == len(encrypted)
 
 
 def test_decrypt_embedded_info_ignores_decoded_host_trailing_bytes():
@@ -27,3 +40,150 @@ def test_decrypt_embedded_info_ignores_decoded_host_trailing_bytes():
     decoded_host_bytes = token + b"\x00\xffnot part of the token"
 
     assert crypt.decrypt_embedded_info("hunter2", decoded_host_bytes) == b"hidden message"
+
+
+def test_encrypted_info_length_finds_token_end_in_decoded_host_bytes():
+    token = crypt.encrypt_info("hunter2", b"hidden message")
+
+    assert crypt.encrypted_info_length(token + b"\x00\xfftrailing") == len(token)
+    assert crypt.encrypted_info_length(token[:8]) is None
+    assert crypt.encrypted_info_length(token[:40]) == len(token)
+
+
+def test_legacy_payloads_are_still_decrypted():
+    token = legacy_encrypt_info("hunter2", b"hidden message" * 5)
+    decoded_host_bytes = token + b"AAAA\x00trailing"
+
+    assert crypt.encrypted_info_length(token + b"\x00trailing") == len(token)
+    assert crypt.encrypted_info_length(token[:40]) is None
+    assert crypt.decrypt_embedded_info("hunter2", decoded_host_bytes) == (
+        b"hidden message" * 5
+    )
+
+
+@pytest.mark.parametrize("cipher", sorted(crypt.CIPHERS))
+def test_envelopes_without_a_key_block_are_rejected(cipher):
+    envelope = bytearray(crypt.encrypt_info("hunter2", b"hidden", cipher))
+    envelope[len(crypt.ENVELOPE_MAGIC)] &= ~crypt.KDF_FLAG
+
+    assert crypt.envelope_cipher(envelope[len(crypt.ENVELOPE_MAGIC)]) is None
+    with pytest.raises(ValueError, match="Unsupported encrypted payload version"):
+        crypt.decrypt_embedded_info("hunter2", bytes(envelope))
+
+
+def test_wrong_password_checks_one_token(monkeypatch):
+    token = crypt.encrypt_info("hunter2", b"hidden message", crypt.FERNET)
+    decoded_host_bytes = token + b"A" * 4096
+    attempts = []
+    decrypt = Fernet.decrypt
+
+    def counting_decrypt(self, token, ttl=None):
+        attempts.append(len(token))
+        return decrypt(self, token, ttl)
+
+    monkeypatch.setattr(Fernet, "decrypt", counting_decrypt)
+
+    with pytest.raises(InvalidToken):
+        crypt.decrypt_embedded_info("wrong", decoded_host_bytes)
+    assert len(attempts) == 1
+
+
+def test_aes_gcm_envelope_is_binary_and_auto_detected():
+    info = b"x" * 300
+    envelope = crypt.encrypt_info("hunter2", info, crypt.AES_GCM)
+
+    assert len(envelope) == crypt.encrypted_info_size(300, crypt.AES_GCM)
+    assert len(envelope) < crypt.encrypted_info_size(300, crypt.FERNET) * 3 // 4
+    assert crypt.encrypted_info_length(envelope + b"trailing") == len(envelope)
+    assert crypt.decrypt_embedded_info("hunter2", envelope + b"trailing") == info
+    with pytest.raises(InvalidTag):
+        crypt.decrypt_embedded_info("wrong", envelope)
+
+
+def test_aes_gcm_envelope_header_is_authenticated():
+    envelope = bytearray(crypt.encrypt_info("hunter2", b"hidden", crypt.AES_GCM))
+    envelope[crypt.ENVELOPE_HEADER.size - 1] += 1  # ciphertext length
+
+    with pytest.raises((InvalidTag, ValueError)):
+        crypt.decrypt_embedded_info("hunter2", bytes(envelope) + b"\x00")
+
+
+@pytest.mark.parametrize("cipher", sorted(crypt.CIPHERS))
+def test_batch_kdf_derives_the_password_key_once(monkeypatch, cipher):
+    monkeypatch.setattr(crypt.cache, "key_cache", crypt.cache.KeyCache())
+    derive = crypt.derive_raw_key
+    calls = []
+
+    def counting_derive(password, salt=None, iterations=crypt.DEFAULT_ITERATIONS):
+        calls.append(salt)
+        return derive(password, salt, iterations)
+
+    monkeypatch.setattr(crypt, "derive_raw_key", counting_derive)
+
+    envelopes = [
+        crypt.encrypt_info("hunter2", b"payload %d" % i, cipher, crypt.BATCH_KDF)
+        for i in range(5)
+    ]
+    for i, envelope in enumerate(envelopes):
+        assert crypt.decrypt_embedded_info("hunter2", envelope) == b"payload %d" % i
+    size = crypt.encrypted_info_size(len(b"payload 0"), cipher, crypt.BATCH_KDF)
+
+    assert len(calls) == 1
+    assert len(envelopes[0]) == size
+    assert len(set(envelopes)) == 5
+
+    crypt.cache.key_cache.clear()
+    assert crypt.decrypt_embedded_info("hunter2", envelopes[0]) == b"payload 0"
+    with pytest.raises((InvalidToken, InvalidTag)):
+        crypt.decrypt_embedded_info("wrong", envelopes[1])
+
+
+@pytest.mark.parametrize("kdf", sorted(crypt.KDFS))
+def test_iterations_are_read_back_from_the_key_block(monkeypatch, kdf):
+    envelope = crypt.encrypt_info("hunter2", b"tuned", crypt.AES_GCM, kdf, 12000)
+    used = []
+    derive = crypt.derive_raw_key
+
+    def recording_derive(password, salt=None, iterations=crypt.DEFAULT_ITERATIONS):
+        used.append(iterations)
+        return derive(password, salt, iterations)
+
+    monkeypatch.setattr(crypt, "derive_raw_key", recording_derive)
+    crypt.cache.key_cache.clear()
+
+    assert crypt.decrypt_embedded_info("hunter2", envelope) == b"tuned"
+    assert used == [12000]
+
+
+def test_out_of_range_iterations_are_rejected():
+    envelope = bytearray(crypt.encrypt_info("hunter2", b"hidden", crypt.AES_GCM))
+    block_start = crypt.ENVELOPE_HEADER.size
+    envelope[block_start + 1 : block_start + 5] = (2**32 - 1).to_bytes(4, "big")
+
+    with pytest.raises(ValueError):
+        crypt.decrypt_embedded_info("hunter2", bytes(envelope))
+    with pytest.raises(ValueError):
+        crypt.encrypt_info("hunter2", b"hidden", iterations=10)
+
+
+@pytest.mark.parametrize("cipher", sorted(crypt.CIPHERS))
+def test_iteration_ceiling_is_checked_before_key_derivation(monkeypatch, cipher):
+    envelope = crypt.encrypt_info("hunter2", b"hidden", cipher, iterations=20000)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("no key should be derived above the ceiling")
+
+    monkeypatch.setattr(crypt, "derive_raw_key", fail)
+    crypt.cache.key_cache.clear()
+
+    with pytest.raises(ValueError):
+        crypt.decrypt_embedded_info("hunter2", envelope, max_iterations=19000)
+
+
+def test_calibrate_iterations_scales_the_sample_time(monkeypatch):
+    clock = iter([0.0, 0.01, 1.0, 1.02, 2.0, 2.04])
+    monkeypatch.setattr(crypt.time, "perf_counter", lambda: next(clock))
+
+    iterations = crypt.calibrate_iterations(0.05)
+
+    assert iterations == crypt.CALIBRATION_ITERATIONS * 5
@@ -1,3 +1,7 @@
+import os
+import time
+import wave
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import numpy as np
@@ -43,10 +47,34 @@ def create_gif_host(path):
     )
 
 
+def create_quantized_gif_host(path, frame_count=6, size=(40, 30)):
+    """Writes frames with their own palettes, so loading them needs a new one."""
+    y = np.arange(size[1]).reshape(-1, 1)
+    x = np.arange(size[0]).reshape(1, -1)
+    frames = []
+    for index in range(frame_count):
+        pixels = np.empty((size[1], size[0], 3), dtype=np.uint8)
+        pixels[:, :, 0] = (x * 6 + index * 40) % 256
+        pixels[:, :, 1] = (y * 8 + index * 25) % 256
+        pixels[:, :, 2] = (x * y + index * 60) % 256
+        frames.append(Image.fromarray(pixels, mode="RGB").quantize(64))
+    frames[0].save(path, save_all=True, append_images=frames[1:], duration=40)
+
+
 def create_wav_host(path, size=12000):
     Path(path).write_bytes(b"RIFF" + b"\x00" * (size - 4))
 
 
+def create_riff_wav_host(path, frames=6000):
+    with wave.open(str(path), "wb") as sound:
+        sound.setnchannels(1)
+        sound.setsampwidth(2)
+        sound.setframerate(8000)
+        sound.writeframes(np.arange(frames, dtype="<i2").tobytes())
+    with open(path, "ab") as f:
+        f.write(b"LIST\x04\x00\x00\x00INFO")
+
+
 def assert_lsb_capacity_boundary(filename, bits):
     host = HostElement(filename)
     capacity = host.free_space(bits)
@@ -82,6 +110,35 @@ def test_jpeg_free_space_matches_encoding_boundary(tmp_path, monkeypatch, bits):
         )
 
 
+@pytest.mark.parametrize("bits", [1, 2, 4])
+def test_estimate_capacity_matches_decoded_hosts(tmp_path, monkeypatch, bits):
+    monkeypatch.chdir(tmp_path)
+    create_rgb_host("host.png", size=(41, 37))
+    Image.open("host.png").convert("L").save("gray.png")
+    create_gif_host("host.gif")
+    create_wav_host("host.wav", size=22345)
+    create_jpeg_host("host.jpg", size=(131, 77))
+    Image.open("host.jpg").save("subsampled.jpg", subsampling=2)
+    Image.open("host.jpg").convert("L").save("gray.jpg")
+    filenames = [
+        "host.png",
+        "gray.png",
+        "host.gif",
+        "host.wav",
+        "host.jpg",
+        "subsampled.jpg",
+        "gray.jpg",
+    ]
+    expected = [HostElement(filename).free_space(bits) for filename in filenames]
+
+    def fail(filename):
+        raise AssertionError("host was decoded")
+
+    monkeypatch.setattr(lsb, "get_file", fail)
+
+    assert [lsb.estimate_capacity(name, bits) for name in filenames] == expected
+
+
 def test_png_text_round_trip(tmp_path, monkeypatch, capsys):
     monkeypatch.chdir(tmp_path)
     create_rgb_host("host.png")
@@ -172,6 +229,82 @@ def test_wrong_password_reports_failure(tmp_path, monkeypatch, capsys):
     assert "Wrong password." in read_output
 
 
+@pytest.mark.parametrize("host_name", ["host.bmp", "host.png", "host.wav", "host.jpg"])
+def test_chunked_encrypted_file_round_trip(tmp_path, monkeypatch, capsys, host_name):
+    monkeypatch.chdir(tmp_path)
+    if host_name == "host.wav":
+        create_riff_wav_host(host_name, frames=200000)
+    elif host_name == "host.jpg":
+        create_jpeg_host(host_name, size=(512, 512))
+    else:
+        create_rgb_host(host_name, size=(512, 512))
+    payload = np.random.default_rng(5).integers(0, 256, 70000, dtype=np.uint8)
+    Path("payload.bin").write_bytes(payload.tobytes())
+
+    host = HostElement(host_name)
+    host.insert_message(
+        payload.tobytes(), 2, "payload.bin", "hunter2", lsb.crypt.AES_GCM_STREAM
+    )
+    host.save()
+    capsys.readouterr()
+
+    def joined_decrypt(*args):
+        raise AssertionError("chunked envelopes must not be decrypted in one piece")
+
+    def read_image(filename):
+        raise AssertionError("streamed PNG hosts must not be decoded in full")
+
+    monkeypatch.setattr(lsb.crypt, "decrypt_embedded_info", joined_decrypt)
+    monkeypatch.setattr(lsb.pngstream, "read_image", read_image)
+
+    HostElement("_" + host_name).read_message("incorrect")
+    assert "Wrong password." in capsys.readouterr().out
+    assert not Path("_payload.bin").exists()
+
+    HostElement("_" + host_name).read_message("hunter2")
+    assert Path("_payload.bin").read_bytes() == payload.tobytes()
+
+
+@pytest.mark.parametrize("kdf", sorted(lsb.crypt.KDFS))
+def test_chunked_encrypted_text_round_trip(tmp_path, monkeypatch, capsys, kdf):
+    monkeypatch.chdir(tmp_path)
+    create_rgb_host("host.png")
+
+    host = HostElement("host.png")
+    host.insert_message(
+        b"chunked", password="hunter2", cipher="aes-gcm-stream", kdf=kdf
+    )
+    host.save()
+    capsys.readouterr()
+    monkeypatch.setattr(lsb.crypt, "decrypt_embedded_info", None)
+
+    HostElement("_host.png").read_message("hunter2")
+
+    assert "chunked" in capsys.readouterr().out
+
+
+def test_tampered_chunked_text_is_reported_as_corrupted(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    create_rgb_host("host.bmp", size=(512, 512))
+
+    host = HostElement("host.bmp")
+    host.insert_message(
+        b"chunked text " * 8000, password="hunter2", cipher="aes-gcm-stream"
+    )
+    host.save()
+    capsys.readouterr()
+    # Flip a carrier of the second chunk; the first one still authenticates.
+    pixels = np.array(Image.open("_host.bmp"))
+    pixels.reshape(-1)[4 * 70000] ^= 1
+    Image.fromarray(pixels).save("_host.bmp")
+
+    HostElement("_host.bmp").read_message("hunter2")
+
+    output = capsys.readouterr().out
+    assert "The encrypted payload is corrupted." in output
+    assert "chunked text" not in output
+
+
 def test_jpeg_text_round_trip(tmp_path, monkeypatch, capsys):
     monkeypatch.chdir(tmp_path)
     create_jpeg_host("host.jpg")
@@ -255,6 +388,100 @@ def test_gif_text_round_trip(tmp_path, monkeypatch, capsys):
     assert "gif payload" in output
 
 
+def test_gif_frames_match_across_workers_and_spilled_buffers(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    create_gif_host("host.gif")
+    header, frames = lsb.get_gif_file("host.gif")
+
+    monkeypatch.setattr(lsb, "GIF_SPILL_BYTES", 0)
+    spilled_header, spilled_frames = lsb.get_gif_file("host.gif", workers=2)
+
+    assert spilled_header == header
+    assert (spilled_frames == frames).all()
+    with pytest.raises(ValueError):
+        lsb.get_gif_file("host.gif", workers=0)
+
+
+def test_quantized_gif_frames_match_across_workers(tmp_path, monkeypatch):
+    create_quantized_gif_host(tmp_path / "host.gif")
+    worker_counts = []
+    original_quantize = lsb.quantize_gif_frames
+
+    def record_workers(rgb_frames, palette, workers=1):
+        worker_counts.append(workers)
+        return original_quantize(rgb_frames, palette, workers)
+
+    monkeypatch.setattr(lsb, "quantize_gif_frames", record_workers)
+    header, frames = lsb.get_gif_file(str(tmp_path / "host.gif"))
+    pooled_header, pooled_frames = lsb.get_gif_file(str(tmp_path / "host.gif"), 3)
+
+    assert worker_counts == [1, 3]
+    assert pooled_header == header
+    assert (pooled_frames == frames).all()
+
+
+def available_cpus():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+@pytest.mark.skipif(available_cpus() < 2, reason="needs two CPUs to overlap loads")
+def test_gif_decodes_scale_with_threads(tmp_path):
+    threads = min(4, available_cpus())
+    paths = []
+    for index in range(threads):
+        path = tmp_path / "host{}.gif".format(index)
+        create_quantized_gif_host(path, frame_count=16, size=(240, 180))
+        paths.append(str(path))
+    expected = [lsb.get_gif_file(path) for path in paths]  # also warms up Pillow
+
+    def best_time(load):
+        times = []
+        for _ in range(3):
+            start = time.perf_counter()
+            results = load()
+            times.append(time.perf_counter() - start)
+        return min(times), results
+
+    serial_time, _ = best_time(lambda: [lsb.get_gif_file(path) for path in paths])
+    with ThreadPoolExecutor(threads) as executor:
+        threaded_time, results = best_time(
+            lambda: list(executor.map(lsb.get_gif_file, paths))
+        )
+
+    assert threaded_time < 0.8 * serial_time
+    for (header, frames), (expected_header, expected_frames) in zip(results, expected):
+        assert header == expected_header
+        assert (frames == expected_frames).all()
+
+
+def test_gif_shared_palette_frames_keep_their_indices(tmp_path):
+    palette = list(range(256)) * 3
+    palette[3:9] = palette[0:3] * 2  # duplicate colors fold to the first index
+    indices = np.arange(60).reshape(6, 10)
+    frames = []
+    for shift in range(3):
+        pixels = ((indices + shift * 50) % 256).astype(np.uint8)
+        frame = Image.fromarray(pixels, mode="P")
+        frame.putpalette(palette)
+        frames.append(frame)
+    frames[0].save(
+        tmp_path / "shared.gif",
+        save_all=True,
+        append_images=frames[1:],
+        palette=bytes(palette),
+    )
+
+    header, decoded = lsb.get_gif_file(str(tmp_path / "shared.gif"))
+    colors = np.asarray(header[0], dtype=np.uint8).reshape(-1, 3)
+    with Image.open(tmp_path / "shared.gif") as image:
+        for index, frame in enumerate(decoded):
+            image.seek(index)
+            assert (colors[frame] == np.asarray(image.convert("RGB"))).all()
+
+
 def test_wav_text_round_trip(tmp_path, monkeypatch, capsys):
     monkeypatch.chdir(tmp_path)
     create_wav_host("host.wav")
@@ -271,6 +498,43 @@ def test_wav_text_round_trip(tmp_path, monkeypatch, capsys):
     assert "audio payload" in output
 
 
+def test_wav_payload_is_embedded_in_the_data_chunk(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    create_riff_wav_host("host.wav")
+    original = Path("host.wav").read_bytes()
+    start, stop = lsb.wav_data_chunk("host.wav")
+
+    host = HostElement("host.wav")
+    host.insert_message(b"audio payload", bits=2)
+    host.save()
+    capsys.readouterr()
+    written = Path("_host.wav").read_bytes()
+
+    assert (start, stop) == (44, 44 + 12000)
+    assert lsb.estimate_capacity("host.wav", 2) == 3000
+    assert Path("host.wav").read_bytes() == original
+    assert len(written) == len(original)
+    assert written[:start] == original[:start]
+    assert written[start + 4 * 24 :] == original[start + 4 * 24 :]
+
+    HostElement("_host.wav").read_message()
+    assert "audio payload" in capsys.readouterr().out
+
+
+def test_wav_decode_falls_back_to_legacy_header(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    create_riff_wav_host("host.wav")
+    sound = np.fromfile("host.wav", dtype=np.uint8)
+    message = lsb.format_message(b"legacy payload", (14).to_bytes(4, "big"))
+    lsb.encode_message(sound[lsb.WAV_LEGACY_HEADER_SIZE :], message, 2)
+    sound.tofile("legacy.wav")
+    capsys.readouterr()
+
+    HostElement("legacy.wav").read_message()
+
+    assert "legacy payload" in capsys.readouterr().out
+
+
 def test_empty_wav_decode_reports_no_payload(tmp_path, monkeypatch, capsys):
     monkeypatch.chdir(tmp_path)
     create_wav_host("host.wav", size=10000)
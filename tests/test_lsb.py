@@ -15,6 +15,16 @@ def test_encode_decode_round_trip_across_bit_depths(bits):
     assert bytes(decoded[: len(message)]) == message
 
 
+def test_encode_message_only_touches_the_payload_prefix():
+    host = np.full(1001, 255, dtype=np.uint8)
+    message = b"abc"
+
+    encoded = lsb.encode_message(host.copy(), message, 2)
+
+    assert (encoded[12:] == 255).all()
+    assert bytes(lsb.decode_message(encoded, len(message))) == message
+
+
 def test_decode_message_handles_empty_host_data():
     decoded = lsb.decode_message(np.zeros(0, dtype=np.uint8))
 
@@ -56,8 +66,99 @@ def test_format_message_for_file_payload():
     assert formatted[11 + len("payload.bin") :] == message
 
 
+def test_embedded_message_length_reads_header():
+    message = b"hello"
+    formatted = lsb.format_message(
+        message, len(message).to_bytes(4, "big"), "payload.bin"
+    )
+
+    assert lsb.embedded_message_length(formatted[:10]) is None
+    assert lsb.embedded_message_length(formatted[:11] + b"\x00" * 40) == len(formatted)
+    assert lsb.embedded_message_length(b"\x00" * 11) == 11
+
+
+def test_read_embedded_message_decodes_only_the_header_and_payload():
+    message = lsb.format_message(b"x" * 300, (300).to_bytes(4, "big"))
+    host = np.zeros(4_000_000, dtype=np.uint8)
+    encoded = lsb.encode_message(host, message, 2)
+    lengths = []
+
+    def decode(length):
+        lengths.append(length)
+        return lsb.decode_message(encoded, length)
+
+    assert bytes(lsb.read_embedded_message(decode)) == message
+    assert lengths == [lsb.HEADER_PROBE_BYTES, len(message)]
+
+
+def test_read_embedded_message_stops_at_exhausted_host():
+    host = np.zeros(40, dtype=np.uint8)
+
+    assert len(lsb.read_embedded_message(lambda n: lsb.decode_message(host, n))) == 5
+
+
 def test_encode_message_rejects_too_large_payload():
     host = np.zeros((2, 2, 3), dtype=np.uint8)
 
     with pytest.raises(SystemExit):
         lsb.encode_message(host, b"this payload is too large", 1)
+
+
+@pytest.mark.parametrize("bits", [1, 2, 4])
+def test_set_jpeg_carrier_values_matches_scalar_rule(bits):
+    coeffs = np.repeat(np.arange(-40, 41, dtype=np.int16), 2**bits)
+    values = np.tile(np.arange(2**bits), 81)
+
+    updated = lsb.set_jpeg_carrier_values(coeffs, values, bits)
+
+    assert updated.dtype == coeffs.dtype
+    assert updated.tolist() == [
+        lsb.set_jpeg_carrier_value(coeff, value, bits)
+        for coeff, value in zip(coeffs, values)
+    ]
+
+
+def test_message_chunks_split_bytes_least_significant_first():
+    assert lsb.message_chunks(b"\xb4", 2).tolist() == [0, 1, 3, 2]
+    assert lsb.message_chunks(b"\xb4\x0f", 4).tolist() == [4, 11, 15, 0]
+
+
+def test_jpeg_carriers_read_and_write_across_channels():
+    channels = [
+        np.zeros((2, 3, 8, 8), dtype=np.int16),
+        np.zeros((1, 1, 8, 8), dtype=np.int16),
+    ]
+    carrier_sets, total = lsb.get_jpeg_carrier_sets(channels)
+    assert total == 7 * 63
+
+    values = np.arange(1, 142, dtype=np.int16)
+    lsb.write_jpeg_carriers(carrier_sets, 300, values)
+
+    assert lsb.read_jpeg_carriers(carrier_sets, 300, total).tolist() == values.tolist()
+    assert channels[1][0, 0, 0, 1] == 79
+    assert not lsb.read_jpeg_carriers(carrier_sets, 0, 300).any()
+    assert not channels[0][..., 0, 0].any()
+
+
+def test_normalize_gif_palette_folds_duplicates_and_fills_unused_slots():
+    palette = [9, 9, 9, 0, 0, 1, 9, 9, 9, 0, 0, 0]
+    frames = np.array([[0, 1, 2, 3, 4]], dtype=np.uint8)
+
+    remapped, normalized = lsb.normalize_gif_palette(frames, palette)
+    colors = np.asarray(normalized).reshape(-1, 3)
+
+    assert remapped.tolist() == [[0, 1, 0, 3, 4]]
+    assert colors[:4].tolist() == [[9, 9, 9], [0, 0, 1], [0, 0, 2], [0, 0, 0]]
+    assert colors[4].tolist() == [0, 0, 3]
+    assert len(normalized) == 768
+    assert len({tuple(color) for color in colors.tolist()}) == 256
+
+
+def test_decode_message_reads_from_an_offset():
+    message = bytes(range(200))
+    host = np.zeros(len(message) * 4, dtype=np.uint8)
+    lsb.encode_message_pieces(host, [message[:7], message[7:]], 2)
+    reader = lsb.MessageReader(lambda n, start: lsb.decode_message(host, n, start))
+
+    assert bytes(lsb.decode_message(host, 50, 120)) == message[120:170]
+    assert reader.read(30) + reader.read(500) == message
@@ -0,0 +1,117 @@
+import numpy as np
+import pytest
+from PIL import Image, PngImagePlugin
+
+from stegpy import lsb, pngstream
+from stegpy.lsb import HostElement
+
+
+def create_filtered_host(path, size=(97, 61)):
+    rng = np.random.default_rng(3)
+    pixels = np.cumsum(rng.integers(0, 3, (size[1], size[0], 3)), axis=1)
+    pixels = pixels.astype(np.uint8)
+    pixels[::7] = rng.integers(0, 256, pixels[::7].shape)
+    info = PngImagePlugin.PngInfo()
+    info.add_text("Comment", "kept")
+    Image.fromarray(pixels).save(path, optimize=True, pnginfo=info)
+    return pixels
+
+
+def test_read_info_accepts_only_8_bit_rgb_non_interlaced(tmp_path):
+    create_filtered_host(tmp_path / "rgb.png")
+    Image.new("RGBA", (4, 4)).save(tmp_path / "rgba.png")
+    header = bytearray((tmp_path / "rgb.png").read_bytes())
+    header[28] = 1  # IHDR interlace method
+    (tmp_path / "interlaced.png").write_bytes(bytes(header))
+
+    assert pngstream.read_info(tmp_path / "rgb.png") == pngstream.PNGInfo(97, 61)
+    assert pngstream.read_info(tmp_path / "rgba.png") is None
+    assert pngstream.read_info(tmp_path / "interlaced.png") is None
+    assert pngstream.read_info(tmp_path / "missing.png") is None
+
+
+def test_read_rows_matches_full_decode(tmp_path):
+    pixels = create_filtered_host(tmp_path / "host.png")
+
+    assert (pngstream.read_rows(tmp_path / "host.png", 10) == pixels[:10]).all()
+    assert (pngstream.read_rows(tmp_path / "host.png", 61) == pixels).all()
+
+
+def test_row_reader_batches_match_full_decode(tmp_path):
+    pixels = create_filtered_host(tmp_path / "host.png")
+    reader = pngstream.RowReader(tmp_path / "host.png")
+
+    batches = [reader.read(count) for count in (1, 6, 20, 40)]
+
+    assert [len(batch) for batch in batches] == [1, 6, 20, 34]
+    assert (np.concatenate(batches) == pixels).all()
+
+
+def test_filter_rows_picks_filters_that_decode_back(tmp_path):
+    pixels = create_filtered_host(tmp_path / "host.png")
+    info = pngstream.PNGInfo(97, 61)
+    flat = pixels.reshape(61, -1)
+
+    data = pngstream.filter_rows(flat, np.zeros(flat.shape[1], dtype=np.uint8))
+    lines = [data[i : i + info.stride] for i in range(0, len(data), info.stride)]
+
+    assert len({line[0] for line in lines}) > 1
+    assert (pngstream.decode_scanlines(info, lines) == pixels).all()
+
+
+@pytest.mark.parametrize(
+    "compress_levels, adaptive", [((6,), False), ((1,), True), ((1, 9), True)]
+)
+def test_write_png_replaces_leading_rows_only(
+    tmp_path, monkeypatch, compress_levels, adaptive
+):
+    # Batches of four scanlines make filters refer across batch boundaries.
+    monkeypatch.setattr(pngstream, "READ_SIZE", 4 * pngstream.PNGInfo(97, 61).stride)
+    pixels = create_filtered_host(tmp_path / "host.png")
+    rows = 255 - pixels[:5]
+
+    pngstream.write_png(
+        tmp_path / "host.png", tmp_path / "out.png", rows, compress_levels, adaptive
+    )
+
+    with Image.open(tmp_path / "out.png") as image:
+        written = np.array(image)
+        assert image.info["Comment"] == "kept"
+    assert (written[:5] == rows).all()
+    assert (written[5:] == pixels[5:]).all()
+
+
+def test_small_streamed_png_is_no_larger_than_fast(tmp_path, capsys):
+    create_filtered_host(tmp_path / "host.png")
+    sizes = {}
+    for profile in ("fast", "small"):
+        host = HostElement(str(tmp_path / "host.png"))
+        host.insert_message(b"profile", bits=2)
+        host.save(tmp_path / (profile + ".png"), profile)
+        sizes[profile] = (tmp_path / (profile + ".png")).stat().st_size
+
+    assert sizes["small"] <= sizes["fast"]
+    fast, small = (Image.open(tmp_path / name) for name in ("fast.png", "small.png"))
+    assert (np.array(fast) == np.array(small)).all()
+
+
+def test_streamed_png_matches_in_memory_embedding(tmp_path, capsys):
+    create_filtered_host(tmp_path / "host.png")
+    streamed = HostElement(str(tmp_path / "host.png"))
+    in_memory = HostElement(str(tmp_path / "host.png"))
+    in_memory.data
+
+    streamed.insert_message(b"streamed payload" * 20, bits=2)
+    in_memory.insert_message(b"streamed payload" * 20, bits=2)
+    streamed.save(tmp_path / "out.png")
+
+    assert streamed.is_streamed()
+    assert (np.array(Image.open(tmp_path / "out.png")) == in_memory.data).all()
+
+    extracted = HostElement(str(tmp_path / "out.png"))
+    message = bytes(lsb.read_embedded_message(extracted.decode))
+    assert message[11:] == b"streamed payload" * 20
+    assert bytes(extracted.decode(320, 11)) == b"streamed payload" * 20
+    reader = lsb.MessageReader(extracted.sequential_decode())
+    assert b"".join(reader.read(size) for size in (11, 7, 300, 13)) == message
+    assert extracted.is_streamed()
@@ -1,11 +1,14 @@
+import io
+import shutil
 import subprocess
 import sys
+import threading
 from pathlib import Path
 
 import numpy as np
 import pytest
 
-from stegpy import steg, video
+from stegpy import cache, crypt, lsb, steg, video
 
 
 def require_video_support():
@@ -31,10 +34,11 @@ def synthetic_frames(size=(240, 160), count=18):
     return frames
 
 
-def create_video_host(path, size=(240, 160), count=18):
+def create_video_host(path, size=(240, 160), count=18, gop=None):
     require_video_support()
     frames = synthetic_frames(size=size, count=count)
     width, height = size
+    keyframe_args = ["-g", str(gop), "-sc_threshold", "0"] if gop else []
     completed = subprocess.run(
         [
             "ffmpeg",
@@ -59,6 +63,7 @@ def create_video_host(path, size=(240, 160), count=18):
             "medium",
             "-pix_fmt",
             "yuv420p",
+            *keyframe_args,
             str(path),
         ],
         input=b"".join(frame.tobytes() for frame in frames),
@@ -70,6 +75,251 @@ def create_video_host(path, size=(240, 160), count=18):
         pytest.skip(completed.stderr.decode("utf-8", "replace"))
 
 
+def reference_embed_bits_in_frame(frame, repeated_bits, bit_index, margin):
+    pixels = frame.astype(np.float32)
+    luminance = (
+        0.299 * pixels[:, :, 0] + 0.587 * pixels[:, :, 1] + 0.114 * pixels[:, :, 2]
+    )
+    size = video.BLOCK_SIZE
+
+    for top in range(0, luminance.shape[0] // size * size, size):
+        for left in range(0, luminance.shape[1] // size * size, size):
+            if bit_index >= len(repeated_bits):
+                break
+            block = luminance[top : top + size, left : left + size]
+            coefficients = video.DCT_MATRIX @ (block - 128.0) @ video.INVERSE_DCT_MATRIX
+            center = (
+                coefficients[video.COEFFICIENT_A] + coefficients[video.COEFFICIENT_B]
+            ) / 2.0
+            sign = 1 if repeated_bits[bit_index] else -1
+            coefficients[video.COEFFICIENT_A] = center + sign * margin / 2.0
+            coefficients[video.COEFFICIENT_B] = center - sign * margin / 2.0
+            updated = (
+                video.INVERSE_DCT_MATRIX @ coefficients @ video.DCT_MATRIX + 128.0
+            )
+            pixels[top : top + size, left : left + size, :] += (updated - block)[
+                :, :, None
+            ]
+            bit_index += 1
+
+    return np.clip(np.rint(pixels), 0, 255).astype(np.uint8), bit_index
+
+
+@pytest.mark.parametrize("start", [0, 7, 570])
+def test_embed_bits_in_frame_matches_per_block_transform(start):
+    frame = synthetic_frames(size=(77, 61), count=1)[0]
+    repeated_bits = np.random.default_rng(3).integers(0, 2, 600).astype(np.uint8)
+
+    expected, expected_index = reference_embed_bits_in_frame(
+        frame, repeated_bits, start, video.DEFAULT_MARGIN
+    )
+    encoded, bit_index = video._embed_bits_in_frame(
+        frame.copy(), repeated_bits, start, video.DEFAULT_MARGIN
+    )
+
+    assert bit_index == expected_index
+    assert np.array_equal(encoded, expected)
+
+
+def test_read_frame_into_fills_buffer_across_short_reads():
+    class ShortReads(io.RawIOBase):
+        def __init__(self, data):
+            self.data = io.BytesIO(data)
+
+        def readinto(self, buffer):
+            return self.data.readinto(memoryview(buffer)[:3])
+
+    stream = ShortReads(bytes(range(10)))
+    buffer = bytearray(8)
+
+    assert video._read_frame_into(stream, buffer) == 8
+    assert buffer == bytes(range(8))
+    assert video._read_frame_into(stream, buffer) == 2
+    assert video._read_frame_into(stream, buffer) == 0
+
+
+def run_embed_stream_through_cat(tmp_path, workers):
+    frames = synthetic_frames(size=(48, 32), count=6)
+    source = tmp_path / "frames.raw"
+    source.write_bytes(b"".join(frame.tobytes() for frame in frames))
+    output = tmp_path / "embedded-{}.raw".format(workers)
+    info = video.VideoInfo(48, 32, "25", len(frames))
+    repeated_bits = video._payload_to_repeated_bits(b"stream", 3)
+    result = []
+    thread = threading.Thread(
+        target=lambda: result.append(
+            video._embed_stream(
+                ["cat", str(source)],
+                ["sh", "-c", 'cat > "$0"', str(output)],
+                info,
+                repeated_bits,
+                video.DEFAULT_MARGIN,
+                workers,
+            )
+        ),
+        daemon=True,
+    )
+    thread.start()
+    thread.join(60)
+    assert not thread.is_alive(), "the encoder never saw the end of its input"
+    return result[0], output.read_bytes()
+
+
+@pytest.mark.skipif(not shutil.which("sh"), reason="needs a POSIX shell and cat")
+def test_embed_stream_with_workers_closes_the_encoder_input(tmp_path):
+    serial = run_embed_stream_through_cat(tmp_path, 1)
+
+    assert run_embed_stream_through_cat(tmp_path, 2) == serial
+    assert serial[0] == len(video._payload_to_repeated_bits(b"stream", 3))
+
+
+@pytest.mark.skipif(not shutil.which("sh"), reason="needs a POSIX shell and cat")
+@pytest.mark.parametrize("workers", [1, 2])
+def test_embed_stream_fails_when_the_frames_run_out(tmp_path, workers):
+    frames = synthetic_frames(size=(48, 32), count=3)
+    source = tmp_path / "frames.raw"
+    source.write_bytes(b"".join(frame.tobytes() for frame in frames))
+    info = video.VideoInfo(48, 32, "25", 60)  # overstated frame count
+    repeated_bits = video._payload_to_repeated_bits(b"stream", 3)
+
+    with pytest.raises(video.VideoProcessingError, match="Video ended before"):
+        video._embed_stream(
+            ["cat", str(source)],
+            ["sh", "-c", 'cat > "$0"', str(tmp_path / "embedded.raw")],
+            info,
+            repeated_bits,
+            video.DEFAULT_MARGIN,
+            workers,
+        )
+
+
+@pytest.mark.skipif(not shutil.which("sh"), reason="needs a POSIX shell and cat")
+def test_decode_payload_reaps_the_decoder_when_parsing_fails(tmp_path, monkeypatch):
+    frame = synthetic_frames(size=(48, 32), count=1)[0]
+    source = tmp_path / "frames.raw"
+    source.write_bytes(frame.tobytes())
+    decoders = []
+    popen = subprocess.Popen
+
+    def recording_popen(*args, **kwargs):
+        decoders.append(popen(*args, **kwargs))
+        return decoders[-1]
+
+    def broken_header(payload, encrypted=False):
+        raise ValueError("broken header")
+
+    monkeypatch.setattr(video, "require_ffmpeg", lambda: None)
+    monkeypatch.setattr(
+        video, "probe_video", lambda *args, **kwargs: video.VideoInfo(48, 32, "25", 1)
+    )
+    # The decoder would keep running long after its only frame.
+    monkeypatch.setattr(
+        video,
+        "_decoder_command",
+        lambda filename: ["sh", "-c", 'cat "$0"; exec sleep 60', str(source)],
+    )
+    monkeypatch.setattr(video.subprocess, "Popen", recording_popen)
+    monkeypatch.setattr(video.lsb, "embedded_message_length", broken_header)
+
+    with pytest.raises(ValueError, match="broken header"):
+        video.decode_payload("host.mp4", stop_early=True)
+    assert decoders[0].returncode is not None
+
+
+def test_extract_bits_from_frame_recovers_embedded_bits():
+    frame = synthetic_frames(size=(77, 61), count=1)[0]
+    repeated_bits = np.random.default_rng(4).integers(0, 2, 63).astype(np.uint8)
+
+    encoded, _ = video._embed_bits_in_frame(
+        frame, repeated_bits, 0, video.DEFAULT_MARGIN
+    )
+    extracted = video._extract_bits_from_frame(encoded)
+
+    assert extracted.dtype == np.uint8
+    assert np.array_equal(extracted, repeated_bits)
+
+
+@pytest.mark.parametrize(
+    "stream, container, expected",
+    [
+        ({"nb_frames": "18", "duration": "1.5"}, {}, (18, True)),
+        ({"nb_frames": "18"}, {}, (18, True)),
+        ({}, {"duration": "1.500000"}, (18, False)),
+        ({"nb_frames": "18", "duration": "9.0"}, {}, None),
+        ({}, {}, None),
+    ],
+)
+def test_estimated_frame_count_uses_headers(stream, container, expected):
+    assert video._estimated_frame_count(stream, "12/1", container) == expected
+
+
+def test_probe_video_reuses_cached_probes_of_copies_and_fuller_modes(
+    tmp_path, monkeypatch
+):
+    monkeypatch.setattr(cache, "probe_cache", cache.MetadataCache())
+    probes = []
+
+    def fake_probe(filename, count_frames):
+        probes.append(count_frames)
+        return video.VideoInfo(48, 32, "25", 6)
+
+    monkeypatch.setattr(video, "_probe_video", fake_probe)
+    (tmp_path / "host.mp4").write_bytes(b"video" * 100)
+    (tmp_path / "upload.mp4").write_bytes(b"video" * 100)
+
+    video.probe_video(tmp_path / "host.mp4")
+    video.probe_video(tmp_path / "upload.mp4")
+    video.probe_video(tmp_path / "host.mp4", count_frames=False)
+    video.probe_video(tmp_path / "host.mp4", count_frames=True)
+    video.probe_video(tmp_path / "upload.mp4", count_frames=False)
+
+    assert probes == [None, True]
+
+
+def probe_packets(monkeypatch, pts_times, keyframes, codec_name="h264"):
+    """Stubs ffprobe with packets listed in the given (decode) order."""
+    data = {
+        "streams": [{"codec_name": codec_name, "pix_fmt": "yuv420p"}],
+        "packets": [
+            {"pts_time": "{:.6f}".format(pts), "flags": "K_" if key else "__"}
+            for pts, key in zip(pts_times, keyframes)
+        ],
+    }
+    monkeypatch.setattr(video, "_run_json", lambda command: data)
+
+
+def test_tail_split_point_orders_b_frame_packets_by_timestamp(monkeypatch):
+    # Open GOP in decode order: I0 P3 B1 B2 I6 B4 B5 P7, starting at 0.08s.
+    frames = [0, 3, 1, 2, 6, 4, 5, 7]
+    probe_packets(
+        monkeypatch,
+        [0.08 + frame * 0.04 for frame in frames],
+        [frame in (0, 6) for frame in frames],
+    )
+
+    split = video._tail_split_point("host.mp4", video.VideoInfo(48, 32, "25", 8), 30)
+
+    assert split[0] == 6
+    assert split[1] == pytest.approx(0.24)
+
+
+def test_tail_split_point_needs_a_keyframe_after_the_payload_frames(monkeypatch):
+    probe_packets(monkeypatch, [0.0, 0.04, 0.08, 0.12], [True, True, False, False])
+    info = video.VideoInfo(48, 32, "25", 4)
+
+    # 30 bits span two frames of 24 blocks, so the keyframe at frame 1 is too early.
+    assert video._tail_split_point("host.mp4", info, 30) is None
+    assert video._tail_split_point("host.mp4", info, 24) == (1, pytest.approx(0.04))
+
+
+def test_tail_split_point_only_splits_h264(monkeypatch):
+    probe_packets(monkeypatch, [0.0, 0.04, 0.08], [True, False, True], "hevc")
+
+    split = video._tail_split_point("host.mp4", video.VideoInfo(48, 32, "25", 3), 1)
+
+    assert split is None
+
+
 def test_video_text_round_trip(tmp_path, monkeypatch, capsys):
     monkeypatch.chdir(tmp_path)
     create_video_host("host.mp4")
@@ -87,6 +337,109 @@ def test_video_text_round_trip(tmp_path, monkeypatch, capsys):
     assert "video payload" in read_output
 
 
+def test_video_copy_tail_round_trip(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    create_video_host("host.mp4", count=36, gop=6)
+
+    video.insert_message("host.mp4", b"copied tail", copy_tail=True)
+    save_output = capsys.readouterr().out
+
+    assert "Re-encoding the first 6 of 36 frames." in save_output
+    assert video.probe_video("_host.mp4").frame_count == 36
+    # The MP4 keeps the libx264 head's parameter sets; the copied tail must
+    # still decode with its own in-band ones.
+    decoded = subprocess.run(
+        ["ffmpeg", "-v", "error", "-i", "_host.mp4", "-f", "null", "-"],
+        capture_output=True,
+        check=True,
+    )
+    assert decoded.stderr == b""
+
+    video.read_message("_host.mp4")
+    read_output = capsys.readouterr().out
+
+    assert "copied tail" in read_output
+
+
+def test_capacity_encode_decode_cycle_probes_once(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    create_video_host("host.mp4")
+    monkeypatch.setattr(cache, "probe_cache", cache.MetadataCache())
+    probes = []
+    run_json = video._run_json
+
+    def counting_run_json(command):
+        probes.append(command[0])
+        return run_json(command)
+
+    monkeypatch.setattr(video, "_run_json", counting_run_json)
+
+    video.video_free_space("host.mp4")
+    video.insert_message("host.mp4", b"probed once")
+    video.read_message("_host.mp4")
+
+    assert "probed once" in capsys.readouterr().out
+    assert probes == ["ffprobe"]
+
+
+def test_overstated_frame_count_leaves_no_output(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    create_video_host("host.mp4")
+    info = video.probe_video("host.mp4")
+    overstated = video.VideoInfo(
+        info.width, info.height, info.fps, 10 * info.frame_count
+    )
+    monkeypatch.setattr(video, "probe_video", lambda *args, **kwargs: overstated)
+    payload = b"x" * (3 * video._carrier_count(info) // video.DEFAULT_REPETITION // 8)
+
+    with pytest.raises(video.VideoProcessingError, match="Video ended before"):
+        video.insert_message("host.mp4", payload)
+    assert not Path("_host.mp4").exists()
+
+
+@pytest.mark.parametrize("password", [None, "hunter2"])
+def test_stop_early_matches_a_full_decode_in_fewer_frames(
+    tmp_path, monkeypatch, capsys, password
+):
+    monkeypatch.chdir(tmp_path)
+    create_video_host("host.mp4")
+    video.insert_message("host.mp4", b"early stop", password=password)
+    capsys.readouterr()
+    reads = []
+    read_frame_into = video._read_frame_into
+
+    def counting_read(stream, buffer):
+        reads.append(1)
+        return read_frame_into(stream, buffer)
+
+    monkeypatch.setattr(video, "_read_frame_into", counting_read)
+    encrypted = password is not None
+
+    full = video.decode_payload("_host.mp4", encrypted=encrypted)
+    full_reads = len(reads)
+    early = video.decode_payload("_host.mp4", stop_early=True, encrypted=encrypted)
+
+    assert early == full[: lsb.embedded_message_length(full, encrypted)]
+    assert len(reads) - full_reads < full_reads
+    if encrypted:
+        assert crypt.decrypt_embedded_info(password, early) == (
+            crypt.decrypt_embedded_info(password, full)
+        )
+
+
+def test_video_parallel_workers_round_trip(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    create_video_host("host.mp4")
+
+    video.insert_message("host.mp4", b"pooled frames " * 4, workers=2)
+    capsys.readouterr()
+
+    video.read_message("_host.mp4")
+    read_output = capsys.readouterr().out
+
+    assert "pooled frames " * 4 in read_output
+
+
 def test_video_free_space_reports_robust_payload_capacity(tmp_path):
     create_video_host(tmp_path / "host.mp4")
 
@@ -97,7 +450,8 @@ def test_video_free_space_reports_robust_payload_capacity(tmp_path):
 
 def test_video_encrypted_text_round_trip(tmp_path, monkeypatch, capsys):
     monkeypatch.chdir(tmp_path)
-    create_video_host("host.mp4")
+    # The envelope and its key block outgrow the 150 bytes of 18 frames.
+    create_video_host("host.mp4", count=24)
 
     video.insert_message("host.mp4", b"secret", password="hunter2")
     capsys.readouterr()
@@ -6,7 +6,7 @@ import pytest
 from fastapi.testclient import TestClient
 from PIL import Image
 
-from stegpy import web
+from stegpy import api, crypt, lsb, web
 from stegpy.web import app
 
 
@@ -342,6 +342,17 @@ def test_encode_and_decode_text_round_trip():
     assert decode_response.json() == {"kind": "text", "message": "hello from web"}
 
 
+def test_encode_rejects_unknown_save_profile():
+    response = client.post(
+        "/api/encode",
+        data={"mode": "text", "message": "hi", "save_profile": "tiny"},
+        files={"host": ("host.png", create_png_bytes(), "image/png")},
+    )
+
+    assert response.status_code == 400
+    assert "fast, balanced, small" in response.json()["detail"]
+
+
 def test_encode_and_decode_encrypted_text_round_trip():
     host = create_png_bytes()
 
@@ -371,6 +382,42 @@ def test_encode_and_decode_encrypted_text_round_trip():
     }
 
 
+def test_encrypted_web_payloads_use_calibrated_iterations(monkeypatch):
+    monkeypatch.setattr(web, "web_kdf_iterations", lambda: 23000)
+
+    encode_response = client.post(
+        "/api/encode",
+        data={"mode": "text", "message": "tuned", "password": "hunter2"},
+        files={"host": ("host.png", create_png_bytes(), "image/png")},
+    )
+    pixels = np.array(Image.open(io.BytesIO(encode_response.content)))
+    block = bytes(lsb.decode_message(pixels, 15))[crypt.ENVELOPE_HEADER.size :]
+
+    assert crypt.KDF_HEADER.unpack(block) == (crypt.KDFS[crypt.PBKDF2], 23000)
+
+
+def test_decode_rejects_payloads_over_the_demo_kdf_ceiling(monkeypatch):
+    monkeypatch.setattr(web, "web_kdf_iterations", lambda: 30000)
+
+    def decode(iterations):
+        host = api.embed(
+            create_png_bytes(),
+            "png",
+            b"costly",
+            password="hunter2",
+            iterations=iterations,
+        )
+        return client.post(
+            "/api/decode",
+            data={"password": "hunter2"},
+            files={"host": ("_host.png", host, "image/png")},
+        )
+
+    assert web.web_max_kdf_iterations() == 120000
+    assert decode(120000).json() == {"kind": "text", "message": "costly"}
+    assert decode(121000).status_code == 400
+
+
 def test_encode_and_decode_file_round_trip():
     host = create_png_bytes()
     payload = b"hidden file payload"
@@ -141,6 +141,8 @@ function setupDemo() {
   const payloadInput = document.getElementById("payload-input");
   const bitsLabel = document.getElementById("bits-label");
   const bitsInput = document.getElementById("bits-input");
+  const saveProfileLabel = document.getElementById("save-profile-label");
+  const saveProfileInput = document.getElementById("save-profile-input");
   const videoModeNote = document.getElementById("video-mode-note");
   const capacityOutput = document.getElementById("capacity-output");
   const payloadOutput = document.getElementById("payload-output");
@@ -390,6 +392,8 @@ function setupDemo() {
     decodeButton.disabled = !currentHost;
     bitsLabel.hidden = videoMode;
     bitsInput.hidden = videoMode;
+    saveProfileLabel.hidden = videoMode;
+    saveProfileInput.hidden = videoMode;
     videoModeNote.hidden = !videoMode;
 
     if (!currentHost) {
@@ -584,6 +588,7 @@ function setupDemo() {
       formData.append("mode", selectedMode());
       formData.append("message", messageInput.value);
       formData.append("bits", String(selectedBits()));
+      formData.append("save_profile", saveProfileInput.value);
       formData.append("password", encodePasswordInput.value);
       if (selectedMode() === "file") {
         formData.append("payload", payloadInput.files[0]);